@@ -1,19 +1,2449 @@
+import os
+import re
 import sys
+import random
+import socket
+import hmac
+import io
+import html
+import json
+import pickle
+import pstats
+import signal
+import sqlite3
 import time
+import queue
+import asyncio
+import bisect
+import cProfile
+import hashlib
 import logging
+import mimetypes
+import threading
 import requests
-from markdown import markdown
+from requests_toolbelt import MultipartEncoder
+from urllib3.connection import HTTPConnection
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache, partial, wraps
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from errbot import botcmd
+from errbot.errBot import ErrBot
+from errbot.backends.base import Message, Person, Room, RoomOccupant, Stream
+
+import ciscosparkapi as sparkapi
+
+log = logging.getLogger('errbot.backends.CiscoSpark')
+
+CISCO_SPARK_WEBHOOK_ID = 'CiscoSparkBackend'
+CISCO_SPARK_WEBHOOK_URI = 'errbot/spark'
+CISCO_SPARK_WEBHOOK_MODE_ROOM = 'room'
+CISCO_SPARK_WEBHOOK_MODE_FIREHOSE = 'firehose'
+CISCO_SPARK_MEMBERSHIP_EVENTS = ('created', 'deleted')
+CISCO_SPARK_WEBHOOK_EVENTS = (('messages', 'created'), ('memberships', 'created'), ('memberships', 'deleted'),
+                              ('rooms', 'updated'))
+CISCO_SPARK_MESSAGE_SIZE_LIMIT = 7439
+CISCO_SPARK_PERSON_CACHE_SIZE = 1024
+CISCO_SPARK_PERSON_CACHE_TTL = 3600
+CISCO_SPARK_PERSON_FAILURE_TTL = 60
+CISCO_SPARK_ROOM_CACHE_SIZE = 256
+CISCO_SPARK_ROOM_CACHE_TTL = 3600
+CISCO_SPARK_ROOM_FAILURE_TTL = 60
+CISCO_SPARK_SEND_WORKERS = 8
+CISCO_SPARK_SEND_QUEUE_SIZE = 1000
+CISCO_SPARK_SEND_DRAIN_TIMEOUT = 10
+CISCO_SPARK_COALESCE_WINDOW = 0
+CISCO_SPARK_MARKDOWN_CACHE_SIZE = 256
+CISCO_SPARK_STARTUP_WORKERS = 10
+CISCO_SPARK_WEBHOOK_LISTEN_HOST = '0.0.0.0'
+CISCO_SPARK_WEBHOOK_WORKERS = 4
+CISCO_SPARK_WEBHOOK_QUEUE_SIZE = 1000
+CISCO_SPARK_WEBHOOK_MAX_BODY = 1024 * 1024
+CISCO_SPARK_WEBHOOK_IDLE_TIMEOUT = 30
+CISCO_SPARK_DEDUPE_WINDOW = 300
+CISCO_SPARK_DEDUPE_SIZE = 10000
+CISCO_SPARK_DEDUPE_PURGE_INTERVAL = 1000
+CISCO_SPARK_SHARD_COUNT = 1
+CISCO_SPARK_SHARD_INDEX = 0
+CISCO_SPARK_SQLITE_TIMEOUT = 30
+CISCO_SPARK_HYDRATION_WORKERS = 8
+CISCO_SPARK_STORAGE_FLUSH_INTERVAL = 5
+CISCO_SPARK_STORAGE_CACHE_SIZE = 1024
+CISCO_SPARK_SNAPSHOT_MAX_AGE = 86400
+CISCO_SPARK_SNAPSHOT_VERSION = 1
+CISCO_SPARK_MEMBERSHIP_PAGE_SIZE = 500
+CISCO_SPARK_ROOM_PAGE_SIZE = 1000
+CISCO_SPARK_DIRECTORY_REFRESH = 300
+CISCO_SPARK_DIRECTORY_RETRY = 30
+CISCO_SPARK_RATE_LIMIT = 20
+CISCO_SPARK_RATE_BURST = 20
+CISCO_SPARK_RATE_MINIMUM = 1
+CISCO_SPARK_RETRIES = 3
+CISCO_SPARK_RETRY_BACKOFF = 0.5
+CISCO_SPARK_PRIORITY_SEND = 0
+CISCO_SPARK_PRIORITY_BACKGROUND = 1
+CISCO_SPARK_HTTP_TIMEOUT = 60
+CISCO_SPARK_HEALTH_CHECK_INTERVAL = 300
+CISCO_SPARK_HTTP_POOL_HOSTS = 4
+CISCO_SPARK_FILE_UPLOAD_LIMIT = 100 * 1024 * 1024
+CISCO_SPARK_FILE_DOWNLOAD_LIMIT = 100 * 1024 * 1024
+CISCO_SPARK_FILE_CHUNK_SIZE = 64 * 1024
+CISCO_SPARK_METRICS_LISTEN_HOST = '0.0.0.0'
+CISCO_SPARK_METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+CISCO_SPARK_PROFILE_MESSAGES = 100
+CISCO_SPARK_PROFILE_MODE_SAMPLE = 'sample'
+CISCO_SPARK_PROFILE_MODE_TRACE = 'trace'
+CISCO_SPARK_PROFILE_SAMPLE_INTERVAL = 0.005
+CISCO_SPARK_PROFILE_UNSET = object()
+CISCO_SPARK_MARKDOWN_EXTENSIONS = ['markdown.extensions.nl2br', 'markdown.extensions.fenced_code']
+
+# A single line of text that markdown would render unchanged inside a paragraph. It may not start with anything that
+# opens a block (list, heading, quote, code, rule) nor contain any inline markdown or HTML syntax.
+CISCO_SPARK_PLAIN_TEXT = re.compile(r'(?![-+=>~#*\s]|\d+\.\s)[^\n\r\t`*_\[\]<>&\\]*(?<!\s)')
+
+# The line opening a fenced code block
+CISCO_SPARK_CODE_FENCE = re.compile(r'(`{3,}|~{3,})')
+
+
+def intern_id(id):
+    """
+    Intern a Spark ID so every object referring to the same person or room shares a single copy of the (long) string
+
+    :param id: The Spark ID or None
+    :return: The interned ID
+    """
+    return sys.intern(id) if isinstance(id, str) else id
+
+
+class CiscoSparkCache(object):
+    """
+    A thread safe LRU cache bounded by size where every entry expires after a time to live (in seconds)
+    """
+    def __init__(self, size, ttl):
+
+        self._size = size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        Return the value cached for key, provided it has not expired
+
+        :param key: The cache key
+        :param default: The value returned when the key is not cached
+        :return: The cached value or default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires, value = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """
+        Return the value cached for key, provided it has not expired, without counting a hit or miss or marking the
+        entry as recently used. For bulk loads that would otherwise skew the statistics and the LRU order.
+
+        :param key: The cache key
+        :param default: The value returned when the key is not cached
+        :return: The cached value or default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return default
+            return entry[1]
+
+    def set(self, key, value):
+        """
+        Cache a value, evicting the least recently used entries when the cache is full
+
+        :param key: The cache key
+        :param value: The value to cache
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic() + self._ttl, value)
+
+            while len(self._entries) > self._size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key=None):
+        """
+        Remove a single entry from the cache, or every entry if no key is provided
+
+        :param key: The cache key
+        """
+        with self._lock:
+            if key is None:
+                for cached in list(self._entries):
+                    self._remove(cached)
+            elif key in self._entries:
+                self._remove(key)
+
+    def values(self):
+        """
+        Return every cached value that has not expired, least recently used first
+
+        :return: A list of the cached values
+        """
+        with self._lock:
+            now = time.monotonic()
+            return [value for expires, value in self._entries.values() if expires >= now]
+
+    def _remove(self, key):
+        self._entries.pop(key)
+
+    @property
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CiscoSparkPersonCache(CiscoSparkCache):
+    """
+    A cache of CiscoSparkPerson keyed by Spark ID that also indexes every person by their email addresses
+    """
+    def __init__(self, size, ttl):
+
+        super().__init__(size, ttl)
+        self._emails = {}
+
+    def get_using_email(self, email, default=None):
+        """
+        Return the cached person that owns an email address
+
+        :param email: The email address
+        :param default: The value returned when the email address is not cached
+        :return: CiscoSparkPerson or default
+        """
+        with self._lock:
+            id = self._emails.get(email.lower())
+            if id is None:
+                self.misses += 1
+                return default
+            return self.get(id, default)
+
+    def set(self, key, value):
+        with self._lock:
+            super().set(key, value)
+            for email in value.emails or []:
+                self._emails[email.lower()] = key
+
+    def _remove(self, key):
+        person = self._entries.pop(key)[1]
+        for email in person.emails or []:
+            if self._emails.get(email.lower()) == key:
+                del self._emails[email.lower()]
+
+
+class CiscoSparkDirectory(object):
+    """
+    A local directory of the rooms the bot is a member of and the people in those rooms
+
+    The rooms are listed a page at a time and the occupants of each room are loaded from its memberships. On refresh
+    only the rooms that are new or have had activity since their occupants were loaded are loaded again. People are
+    indexed by id, email and (case-insensitive) name, with the names also kept sorted for prefix searches.
+
+    The directory is loaded and refreshed in the background, lookups never call Spark. Until the directory is first
+    loaded the lookups by id, email and name find nothing (so callers fall back to the Spark API) while listing the
+    rooms, the people or searching waits for it to be loaded.
+    """
+    def __init__(self, bot, refresh_interval, workers):
+
+        self._bot = bot
+        self._refresh_interval = refresh_interval
+        self._workers = workers
+        self._rooms = OrderedDict()
+        self._activity = {}
+        self._people = {}
+        self._emails = {}
+        self._names = {}
+        self._sorted_names = []
+        self._loaded = False
+        self._stale = False
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._stopped = None
+        self._thread = None
+
+    def start(self):
+        """
+        Load the directory in the background and keep refreshing it every refresh_interval seconds (0 to only load
+        it). Does nothing when the directory is already started.
+        """
+        if self._thread:
+            return
+
+        # Each thread has its own event so a thread still finishing a refresh is not restarted by clearing it
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stopped,), name='CiscoSparkDirectory',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stopped.set()
+            self._thread = None
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def rooms(self):
+        """
+        :return: A list of CiscoSparkRoom
+        """
+        self._wait_loaded()
+        with self._lock:
+            return list(self._rooms.values())
+
+    def people(self):
+        """
+        :return: A list of CiscoSparkPerson
+        """
+        self._wait_loaded()
+        with self._lock:
+            return list(self._people.values())
+
+    def get(self, id):
+        """
+        Return a person using their Spark ID
+
+        :param id: The Spark ID of the person
+        :return: CiscoSparkPerson or None
+        """
+        self._ensure_indexed()
+        with self._lock:
+            return self._people.get(id)
+
+    def get_using_email(self, email):
+        """
+        Return a person using their email address
+
+        :param email: The email address
+        :return: CiscoSparkPerson or None
+        """
+        self._ensure_indexed()
+        with self._lock:
+            return self._people.get(self._emails.get(email.lower()))
+
+    def find_using_name(self, name):
+        """
+        Return every person whose display name matches, ignoring case
+
+        :param name: The display name
+        :return: A list of CiscoSparkPerson
+        """
+        self._ensure_indexed()
+        with self._lock:
+            return [self._people[id] for id in self._names.get(name.lower(), [])]
+
+    def search(self, prefix):
+        """
+        Return every person whose display name starts with a prefix, ignoring case, ordered by name
+
+        :param prefix: The start of the display name
+        :return: A list of CiscoSparkPerson
+        """
+        self._wait_loaded()
+        prefix = prefix.lower()
+
+        with self._lock:
+            people = []
+            for name, id in self._sorted_names[bisect.bisect_left(self._sorted_names, (prefix,)):]:
+                if not name.startswith(prefix):
+                    break
+                people.append(self._people[id])
+            return people
+
+    def get_room(self, id):
+        """
+        Return a room of the directory without loading the directory
+
+        :param id: The Spark ID of the room
+        :return: CiscoSparkRoom or None
+        """
+        with self._lock:
+            return self._rooms.get(id)
+
+    def membership_changed(self):
+        """
+        Flag that the occupants of a room have changed so the people are indexed again on the next lookup
+        """
+        self._stale = True
+
+    def refresh(self):
+        """
+        List the rooms of the bot, load the occupants of the rooms that are new or have changed and index the people
+        """
+        with self._refresh_lock:
+            self._refresh()
+
+    def _refresh(self):
+        log.debug("Refreshing the directory")
+
+        with self._lock:
+            known = dict(self._rooms)
+            activity = dict(self._activity)
+
+        rooms = OrderedDict()
+        for spark_room in self._bot.session.rooms.list(max=CISCO_SPARK_ROOM_PAGE_SIZE):
+            # Use the cached room where there is one so that webhook events keep its occupants current
+            room = self._bot.room_cache.peek(spark_room.id) or known.get(spark_room.id)
+            if room is None:
+                room = CiscoSparkRoom(self._bot, spark_room)
+            else:
+                room._set_details(spark_room._json_data)
+            rooms[room.id] = room
+
+        changed = [room for room in rooms.values()
+                   if room._members is None or activity.get(room.id) != room._last_activity]
+
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            for room, future in [(room, pool.submit(room.update_occupants)) for room in changed]:
+                if future.exception():
+                    log.error("Failed to load the occupants of room {}: {}".format(room.id, future.exception()))
+                else:
+                    activity[room.id] = room._last_activity
+
+        with self._lock:
+            self._rooms = rooms
+            self._activity = {id: activity[id] for id in rooms if id in activity}
+            self._index()
+            self._loaded = True
+
+        log.debug("Done! The directory holds {} rooms ({} loaded) and {} people".format(
+            len(rooms), len(changed), len(self._people)))
+
+    def _wait_loaded(self):
+        if not self._loaded:
+            with self._refresh_lock:
+                # Waits for the load started in the background, only loading here when it has not run or failed
+                if not self._loaded:
+                    self._refresh()
+        self._ensure_indexed()
+
+    def _ensure_indexed(self):
+        if self._stale:
+            with self._lock:
+                self._index()
+
+    def _index(self):
+        self._stale = False
+
+        people = {}
+        emails = {}
+        names = {}
+
+        for room in self._rooms.values():
+            for occupant in room.occupants if room._members is not None else []:
+                if occupant.id in people:
+                    continue
+                person = people[occupant.id] = CiscoSparkPerson(self._bot, occupant)
+                for email in person.emails:
+                    emails[email.lower()] = person.id
+                if person.displayName:
+                    names.setdefault(person.displayName.lower(), []).append(person.id)
+
+        self._people = people
+        self._emails = emails
+        self._names = names
+        self._sorted_names = sorted((name, id) for name, ids in names.items() for id in ids)
+
+    def _run(self, stopped):
+        while not stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                log.exception("Failed to refresh the directory")
+            else:
+                if not self._refresh_interval:
+                    break
+            stopped.wait(self._refresh_interval or CISCO_SPARK_DIRECTORY_RETRY)
+
+
+class CiscoSparkHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    A requests HTTPAdapter that can enable TCP keep-alive on the pooled connections so that idle connections are kept
+    open (and dead ones detected) rather than being churned
+    """
+    def __init__(self, keepalive=True, **kwargs):
+
+        self._keepalive = keepalive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self._keepalive:
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+class CiscoSparkUploadFile(object):
+    """
+    Reads the given number of bytes from a file being uploaded. The MultipartEncoder asks the file it streams for its
+    position to work out how much is left, which files that can not seek (such as pipes) are unable to answer.
+    """
+    def __init__(self, file, size):
+
+        self._file = file
+        # Read by the MultipartEncoder as the number of bytes left
+        self.len = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.len:
+            size = self.len
+
+        chunk = self._file.read(size)
+        if size and not chunk:
+            raise ValueError("The file ended {} bytes short of its size".format(self.len))
+
+        self.len -= len(chunk)
+        return chunk
+
+
+class CiscoSparkUpload(object):
+    """
+    A multipart/form-data request body that streams a file to Spark a chunk at a time rather than reading it into
+    memory. The body can be rewound so a rate limited upload can be retried, provided the file can seek.
+    """
+    def __init__(self, fields, name, file, size, content_type):
+
+        self._fields = fields
+        self._name = name
+        self._file = file
+        self._size = size
+        self._content_type = content_type
+        self._start = file.tell() if file.seekable() else None
+        self._encoder = self._encode()
+
+    @property
+    def content_type(self):
+        return self._encoder.content_type
+
+    @property
+    def len(self):
+        # Read by requests to set the Content-Length of the upload
+        return self._encoder.len
+
+    def read(self, size=-1):
+        return self._encoder.read(size)
+
+    def rewind(self):
+        """
+        Start the body again from the beginning
+        """
+        if self._start is None:
+            raise ValueError("The upload of {} can not be repeated as the file can not seek".format(self._name))
+        self._file.seek(self._start)
+        self._encoder = self._encode()
+
+    def sent(self, response, *args, **kwargs):
+        """
+        A requests response hook that describes the upload in place of the body of the request, as ciscosparkapi
+        includes the body of a failed request in its error and can only do so when it is text
+        """
+        response.request.body = '<{} ({} bytes)>'.format(self._name, self._size)
+
+    def _encode(self):
+        file = CiscoSparkUploadFile(self._file, self._size)
+        return MultipartEncoder(dict(self._fields, files=(self._name, file, self._content_type)))
+
+
+class CiscoSparkRateGovernor(object):
+    """
+    Paces every request made through a CiscoSparkAPI session to stay within the Spark rate limits
+
+    Requests take a token from a token bucket refilled at the current rate (up to rate_limit requests per second).
+    When Spark responds with a 429 all requests are paused for the Retry-After period, the rate is halved and the
+    request is retried. Every successful request then recovers the rate a little (additive increase, multiplicative
+    decrease). Requests that post messages are given their token before any waiting background request, and
+    idempotent requests are retried with jittered exponential backoff when they fail with a server or connection error.
+    """
+    def __init__(self, rate_limit, burst, retries):
+
+        self._rate_limit = rate_limit
+        self._rate = rate_limit
+        self._burst = burst
+        self._retries = retries
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._waiting = {CISCO_SPARK_PRIORITY_SEND: 0, CISCO_SPARK_PRIORITY_BACKGROUND: 0}
+        self._condition = threading.Condition()
+        self.throttled = 0
+        self.retried = 0
+
+    @property
+    def rate(self):
+        """
+        The number of requests per second currently allowed
+        """
+        return self._rate
+
+    def install(self, api):
+        """
+        Route every request made by a CiscoSparkAPI session through the governor
+
+        :param api: The sparkapi.CiscoSparkAPI session
+        """
+        rest = api._session
+        rest.wait_on_rate_limit = False
+        rest.request = partial(self.request, rest.request)
+
+    def request(self, send, method, url, erc, **kwargs):
+        """
+        Make a request once a token is available, retrying it as required
+
+        :param send: The function that makes the request (RestSession.request)
+        :param method: The HTTP method
+        :param url: The URL of the API endpoint
+        :param erc: The expected response code
+        :return: The requests.Response
+        """
+        priority = CISCO_SPARK_PRIORITY_SEND if method == 'POST' and url.rstrip('/').endswith('messages') \
+            else CISCO_SPARK_PRIORITY_BACKGROUND
+        idempotent = method in ('GET', 'HEAD', 'PUT', 'DELETE')
+        attempt = 0
+
+        while True:
+            self.acquire(priority)
+
+            try:
+                response = send(method, url, erc, **kwargs)
+
+            except sparkapi.exceptions.SparkRateLimitError as error:
+                # A rate limited request was not processed by Spark so it is safe to retry whatever the method
+                self._throttle(error.retry_after)
+                if attempt >= self._retries:
+                    raise
+
+            except (sparkapi.exceptions.SparkApiError, requests.ConnectionError, requests.Timeout) as error:
+                response = getattr(error, 'response', None)
+                if not idempotent or attempt >= self._retries or (response is not None and response.status_code < 500):
+                    raise
+                time.sleep(CISCO_SPARK_RETRY_BACKOFF * 2 ** attempt * (1 + random.random()))
+
+            else:
+                self._recover()
+                return response
+
+            attempt += 1
+            self.retried += 1
+            log.debug("Retrying {} {} (attempt {})".format(method, url, attempt + 1))
+
+            # A streamed body (e.g. a file upload) has been read and has to start again
+            rewind = getattr(kwargs.get('data'), 'rewind', None)
+            if rewind:
+                rewind()
+
+    def acquire(self, priority=CISCO_SPARK_PRIORITY_BACKGROUND):
+        """
+        Wait until a request may be made
+
+        :param priority: CISCO_SPARK_PRIORITY_SEND or CISCO_SPARK_PRIORITY_BACKGROUND
+        """
+        with self._condition:
+            self._waiting[priority] += 1
+
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+                    self._updated = now
+
+                    delay = self._paused_until - now
+                    if delay <= 0:
+                        if priority != CISCO_SPARK_PRIORITY_SEND and self._waiting[CISCO_SPARK_PRIORITY_SEND]:
+                            # Let the waiting sends go first, they notify when they are done
+                            delay = None
+                        elif self._tokens >= 1:
+                            self._tokens -= 1
+                            return
+                        else:
+                            delay = (1 - self._tokens) / self._rate
+
+                    self._condition.wait(delay)
+
+            finally:
+                self._waiting[priority] -= 1
+                self._condition.notify_all()
+
+    def _throttle(self, retry_after):
+        with self._condition:
+            self.throttled += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._rate = max(CISCO_SPARK_RATE_MINIMUM, self._rate / 2)
+            self._tokens = 0
+            log.warning("Rate limited by Spark, pausing requests for {} seconds and reducing the rate to {:.1f}/s".
+                        format(retry_after, self._rate))
+
+    def _recover(self):
+        if self._rate < self._rate_limit:
+            with self._condition:
+                self._rate = min(self._rate_limit, self._rate + self._rate_limit / 100)
+
+
+class CiscoSparkSingleFlight(object):
+    """
+    Collapses concurrent calls for the same key into a single call whose result is shared by all of the callers
+    """
+    def __init__(self):
+
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        """
+        Call function(*args) unless a call for the same key is already in flight, in which case wait for its result
+
+        :param key: The key identifying the call (e.g. the Spark id being loaded)
+        :param function: The function to call
+        :return: The result of the call
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = function(*args)
+            future.set_result(result)
+            return result
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class CiscoSparkDedupeWindow(object):
+    """
+    Remembers the keys seen within the last window seconds (up to a maximum of size keys) so repeated deliveries of
+    the same event can be dropped
+    """
+    def __init__(self, window, size):
+
+        self._window = window
+        self._size = size
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def seen(self, key):
+        """
+        Record a key, reporting whether it was already seen within the window
+
+        :param key: The key (e.g. message id)
+        :return: True if the key is a duplicate
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            # Keys are only ever appended so the oldest are always at the front
+            while self._seen and next(iter(self._seen.values())) < now:
+                self._seen.popitem(last=False)
+
+            if key in self._seen:
+                self.duplicates += 1
+                return True
+
+            # Only make room once the key is known to be new, so a full window still recognises its oldest key
+            while len(self._seen) >= self._size:
+                self._seen.popitem(last=False)
+
+            self._seen[key] = now + self._window
+            return False
+
+    def forget(self, key):
+        """
+        Forget a key so that it will be accepted again (e.g. because processing it failed)
+
+        :param key: The key
+        """
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def __len__(self):
+        return len(self._seen)
+
+
+class CiscoSparkWriteBackStore(object):
+    """
+    An in memory write-back layer in front of the errbot storage that holds the per room/person dictionaries used by
+    remember, forget and recall
+
+    Each dictionary is read from storage once and then changed in memory under a lock specific to its id, so
+    concurrent writers no longer lose updates. Changed dictionaries are written back every flush_interval seconds (all
+    the changes made to a dictionary in that time cost a single write). A flush_interval of 0 writes every change
+    straight through.
+
+    Up to size dictionaries are held, the least recently used being dropped once they have been written back. The lock
+    of an id only exists while the id is in use.
+    """
+    def __init__(self, storage, flush_interval, size=CISCO_SPARK_STORAGE_CACHE_SIZE):
+
+        self._storage = storage
+        self._flush_interval = flush_interval
+        self._size = size
+        self._values = OrderedDict()
+        self._locks = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def get(self, id):
+        """
+        Return a copy of the dictionary for an id
+
+        :param id: Spark ID of room or person
+        :return: A dictionary
+        """
+        with self._locked(id):
+            return dict(self._load(id))
+
+    def get_key(self, id, key):
+        """
+        Return the value of a key from the dictionary for an id
+
+        :param id: Spark ID of room or person
+        :param key: The dictionary key
+        :return: Either the value of the key or None if the key is not found
+        """
+        with self._locked(id):
+            return self._load(id).get(key)
+
+    def set_key(self, id, key, value):
+        """
+        Set the value of a key in the dictionary for an id
+
+        :param id: Spark ID of room or person
+        :param key: The dictionary key
+        :param value: The value to be assigned to the key
+        """
+        with self._locked(id):
+            self._load(id)[key] = value
+            self._changed(id)
+
+    def pop_key(self, id, key):
+        """
+        Remove a key from the dictionary for an id
+
+        :param id: Spark ID of room or person
+        :param key: The dictionary key
+        :return: The popped value or None if the key was not found
+        """
+        with self._locked(id):
+            value = self._load(id).pop(key, None)
+            self._changed(id)
+            return value
+
+    @property
+    def dirty(self):
+        """
+        The number of dictionaries waiting to be written to storage
+        """
+        return len(self._dirty)
+
+    def flush(self):
+        """
+        Write every changed dictionary back to storage
+        """
+        with self._flush_lock:
+            with self._lock:
+                dirty = list(self._dirty)
+
+            for id in dirty:
+                # A dictionary stays dirty, and so is not dropped, until it has been written
+                with self._locked(id):
+                    try:
+                        self._storage[id] = dict(self._values[id])
+                    except Exception:
+                        log.exception("Failed to write {} to storage".format(id))
+                    else:
+                        with self._lock:
+                            self._dirty.discard(id)
+
+            with self._lock:
+                self._evict()
+
+    def stop(self):
+        """
+        Stop the periodic flushes and write any remaining changes to storage
+        """
+        if self._thread:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+            self._stopped.clear()
+
+        self.flush()
+
+    @contextmanager
+    def _locked(self, id):
+        # Hold the lock for an id, counting its users so that it is dropped by the last of them
+        with self._lock:
+            entry = self._locks.get(id)
+            if entry is None:
+                entry = self._locks[id] = [threading.Lock(), 0]
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[id]
+
+    def _load(self, id):
+        # The caller must hold the lock for the id
+        with self._lock:
+            values = self._values.get(id)
+            if values is not None:
+                self._values.move_to_end(id)
+                return values
+
+        values = dict(self._storage.get(id) or {})
+
+        with self._lock:
+            self._values[id] = values
+            self._evict()
+        return values
+
+    def _evict(self):
+        # The caller must hold self._lock. Dictionaries that are in use or not yet written back are kept.
+        evicted = []
+        for id in self._values:
+            if len(self._values) - len(evicted) <= self._size:
+                break
+            if id not in self._dirty and id not in self._locks:
+                evicted.append(id)
+
+        for id in evicted:
+            del self._values[id]
+
+    def _changed(self, id):
+        # The caller must hold the lock for the id
+        if not self._flush_interval:
+            self._storage[id] = dict(self._values[id])
+            return
+
+        with self._lock:
+            self._dirty.add(id)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='CiscoSparkWriteBackStore', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self._flush_interval):
+            self.flush()
+
+
+class CiscoSparkSQLite(object):
+    """
+    A SQLite database shared by the worker processes of a sharded bot. Every statement is committed as it is run and
+    concurrent writers (threads or processes) wait for each other rather than failing.
+    """
+    def __init__(self, path):
+
+        self._connection = sqlite3.connect(path, timeout=CISCO_SPARK_SQLITE_TIMEOUT, isolation_level=None,
+                                           check_same_thread=False)
+        self._lock = threading.Lock()
+
+        # Write-ahead logging lets the readers in other processes carry on while a write is in progress
+        self.execute('PRAGMA journal_mode=WAL')
+
+    def execute(self, sql, parameters=()):
+        """
+        Run a statement
+
+        :param sql: The SQL statement
+        :param parameters: The values of the statement parameters
+        :return: A tuple of the rows returned and the number of rows changed
+        """
+        with self._lock:
+            cursor = self._connection.execute(sql, parameters)
+            return cursor.fetchall(), cursor.rowcount
+
+    def transaction(self, function):
+        """
+        Run a function in a transaction that holds the write lock of the database for its duration
+
+        :param function: A callable that is passed the connection
+        :return: The return value of function
+        """
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = function(self._connection)
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+            return result
+
+
+class CiscoSparkSharedStore(object):
+    """
+    Holds the per room/person dictionaries used by remember, forget and recall in a SQLite database so that every
+    worker process of a sharded bot sees the same values. Each key of a dictionary is its own row, so writers only
+    contend on the keys they change and every change is visible to the other workers as soon as it is made.
+    """
+    def __init__(self, database):
+
+        self._database = database
+        self._database.execute(
+            'CREATE TABLE IF NOT EXISTS storage (id TEXT, key BLOB, value BLOB, PRIMARY KEY (id, key))'
+        )
+
+    def get(self, id):
+        """
+        Return a copy of the dictionary for an id
+
+        :param id: Spark ID of room or person
+        :return: A dictionary
+        """
+        rows, _ = self._database.execute('SELECT key, value FROM storage WHERE id = ?', (id,))
+        return {pickle.loads(key): pickle.loads(value) for key, value in rows}
+
+    def get_key(self, id, key):
+        """
+        Return the value of a key from the dictionary for an id
+
+        :param id: Spark ID of room or person
+        :param key: The dictionary key
+        :return: Either the value of the key or None if the key is not found
+        """
+        rows, _ = self._database.execute('SELECT value FROM storage WHERE id = ? AND key = ?', (id, pickle.dumps(key)))
+        return pickle.loads(rows[0][0]) if rows else None
+
+    def set_key(self, id, key, value):
+        """
+        Set the value of a key in the dictionary for an id
+
+        :param id: Spark ID of room or person
+        :param key: The dictionary key
+        :param value: The value to be assigned to the key
+        """
+        self._database.execute('INSERT OR REPLACE INTO storage (id, key, value) VALUES (?, ?, ?)',
+                               (id, pickle.dumps(key), pickle.dumps(value)))
+
+    def pop_key(self, id, key):
+        """
+        Remove a key from the dictionary for an id
+
+        :param id: Spark ID of room or person
+        :param key: The dictionary key
+        :return: The popped value or None if the key was not found
+        """
+        def pop(connection):
+            parameters = (id, pickle.dumps(key))
+            row = connection.execute('SELECT value FROM storage WHERE id = ? AND key = ?', parameters).fetchone()
+            connection.execute('DELETE FROM storage WHERE id = ? AND key = ?', parameters)
+            return pickle.loads(row[0]) if row else None
+
+        return self._database.transaction(pop)
+
+    @property
+    def dirty(self):
+        """
+        Changes are written as they are made so nothing is ever waiting to be written
+        """
+        return 0
+
+    def flush(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class CiscoSparkSharedDedupe(object):
+    """
+    A dedupe window kept in a SQLite database so a message delivered to more than one worker process of a sharded bot
+    is only processed once
+    """
+    def __init__(self, database, window):
+
+        self._database = database
+        self._window = window
+        self._count = 0
+        self.duplicates = 0
+        self._database.execute('CREATE TABLE IF NOT EXISTS dedupe (key TEXT PRIMARY KEY, expires REAL)')
+
+    def seen(self, key):
+        """
+        Record a key, reporting whether it was already seen within the window
+
+        :param key: The key (e.g. message id)
+        :return: True if the key is a duplicate
+        """
+        # Wall clock time as the expiry times are compared between processes
+        now = time.time()
+
+        self._count += 1
+        if self._count % CISCO_SPARK_DEDUPE_PURGE_INTERVAL == 0:
+            self._database.execute('DELETE FROM dedupe WHERE expires < ?', (now,))
+
+        # Only a new key, or one whose window has expired, changes a row
+        _, changed = self._database.execute(
+            'INSERT INTO dedupe (key, expires) VALUES (?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET expires = excluded.expires WHERE dedupe.expires < ?',
+            (key, now + self._window, now)
+        )
+
+        if not changed:
+            self.duplicates += 1
+            return True
+        return False
+
+    def forget(self, key):
+        """
+        Forget a key so that it will be accepted again (e.g. because processing it failed)
+
+        :param key: The key
+        """
+        self._database.execute('DELETE FROM dedupe WHERE key = ?', (key,))
+
+    def __len__(self):
+        rows, _ = self._database.execute('SELECT COUNT(*) FROM dedupe WHERE expires >= ?', (time.time(),))
+        return rows[0][0]
+
+
+class CiscoSparkSnapshot(object):
+    """
+    An on-disk snapshot of the bot identity, the room details and the person cache used to start the bot without
+    waiting on the Spark API. The snapshot records a hash of the bot token so a snapshot taken by another bot is never
+    used.
+    """
+    def __init__(self, path, token, max_age):
+
+        self._path = path
+        self._token = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        self._max_age = max_age
+
+    def load(self):
+        """
+        Read the snapshot
+
+        :return: The snapshot or None when there is no usable snapshot
+        """
+        try:
+            with open(self._path) as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            log.exception("Failed to read the snapshot {}".format(self._path))
+            return None
+
+        if snapshot.get('version') != CISCO_SPARK_SNAPSHOT_VERSION or snapshot.get('token') != self._token:
+            log.info("Ignoring the snapshot {} as it was taken by another bot or version".format(self._path))
+            return None
+
+        if time.time() - snapshot.get('created', 0) > self._max_age:
+            log.info("Ignoring the snapshot {} as it is older than {} seconds".format(self._path, self._max_age))
+            return None
+
+        return snapshot
+
+    def save(self, me, rooms, people):
+        """
+        Replace the snapshot
+
+        :param me: The details of the bot itself
+        :param rooms: A list of room details
+        :param people: A list of person details
+        """
+        snapshot = {
+            'version': CISCO_SPARK_SNAPSHOT_VERSION,
+            'token': self._token,
+            'created': time.time(),
+            'me': me,
+            'rooms': rooms,
+            'people': people,
+        }
+
+        # Write to a temporary file first so a crash while saving never leaves a truncated snapshot behind
+        temporary = '{}.tmp'.format(self._path)
+        try:
+            with open(temporary, 'w') as file:
+                json.dump(snapshot, file)
+            os.replace(temporary, self._path)
+        except OSError:
+            log.exception("Failed to save the snapshot {}".format(self._path))
+            return
+
+        log.debug("Saved a snapshot of {} rooms and {} people to {}".format(len(rooms), len(people), self._path))
+
+
+class CiscoSparkMarkdown(object):
+    """
+    Renders message bodies to the markdown (HTML) sent to Cisco Spark
+
+    Plain text is wrapped in a paragraph without running the markdown pipeline, and the output of the most recently
+    rendered bodies is memoized. Each thread is given its own Markdown instance as they are not thread safe.
+
+    Bodies too large for a single Spark message are split between paragraphs, lines or the lines of a code block
+    (closing the block at the end of one chunk and opening it again in the next) so every chunk renders correctly.
+    """
+    def __init__(self, cache_size):
+
+        self._local = threading.local()
+        self._render_markdown = lru_cache(maxsize=cache_size)(self._convert)
+
+    def render(self, body):
+        """
+        Render a message body
+
+        :param body: The message text
+        :return: The rendered HTML
+        """
+        if body and CISCO_SPARK_PLAIN_TEXT.fullmatch(body):
+            return '<p>{}</p>'.format(body)
+        return self._render_markdown(body)
+
+    def split(self, body, limit):
+        """
+        Split a message body into chunks whose text and rendered markdown are both no longer than limit. The chunks
+        are generated as they are needed so the first can be sent while the rest of the body is still being split.
+
+        :param body: The message text
+        :param limit: The maximum length of the text and of the markdown of a chunk
+        :return: A generator of (text, markdown) tuples
+        """
+        if len(body) <= limit:
+            markdown = self.render(body)
+            if len(markdown) <= limit:
+                yield body, markdown
+                return
+
+        chunk = []
+        size = 0
+
+        for block, block_size in self._blocks(body, limit):
+            # Blocks are joined by a blank line, which is allowed for in their size
+            if chunk and size + block_size + 2 > limit:
+                yield from self._fit(chunk, limit)
+                chunk = []
+                size = 0
+            chunk.append(block)
+            size += block_size + 2
+
+        if chunk:
+            yield from self._fit(chunk, limit)
+
+    @property
+    def cache_info(self):
+        return self._render_markdown.cache_info()
+
+    def _size(self, text, limit):
+        # Text that is already too long is not rendered, as rendering a large paragraph can be very slow. Chunks are
+        # rendered without the memo cache so splitting a large body does not evict every useful entry.
+        if len(text) > limit:
+            return len(text)
+        markdown = '<p>{}</p>'.format(text) if CISCO_SPARK_PLAIN_TEXT.fullmatch(text) else self._convert(text)
+        return max(len(text), len(markdown))
+
+    def _fit(self, blocks, limit):
+        """
+        Render a chunk of blocks, halving the chunk in the rare case that it renders larger than the sum of its blocks
+        and breaking a single block again for a smaller limit when it renders larger than it was measured
+        """
+        text = '\n\n'.join(blocks)
+        markdown = self._convert(text)
+
+        if len(text) <= limit and len(markdown) <= limit:
+            yield text, markdown
+        elif len(blocks) > 1:
+            middle = len(blocks) // 2
+            yield from self._fit(blocks[:middle], limit)
+            yield from self._fit(blocks[middle:], limit)
+        else:
+            excess = max(len(text), len(markdown)) - limit
+            smaller = limit
+            parts = [text]
+            while len(parts) == 1 and smaller > excess:
+                smaller -= excess
+                parts = [block for block, _ in self._blocks(text, smaller)]
+
+            if len(parts) == 1:
+                log.warning("Unable to split a block of {} characters into chunks of {}".format(len(text), limit))
+                yield text, markdown
+                return
+
+            for part in parts:
+                yield from self._fit([part], limit)
+
+    def _blocks(self, body, limit):
+        """
+        Break a body into paragraphs and code blocks, breaking any that are larger than limit on their own
+
+        :return: A generator of (block, size) tuples
+        """
+        paragraph = []
+        code = []
+        fence = None
+
+        for line in body.split('\n'):
+            if fence is None:
+                match = CISCO_SPARK_CODE_FENCE.match(line)
+                if match or not line.strip():
+                    yield from self._paragraph_blocks(paragraph, limit)
+                    paragraph = []
+                if match:
+                    fence = match.group(1)
+                    code = [line]
+                elif line.strip():
+                    paragraph.append(line)
+            else:
+                code.append(line)
+                closing = line.strip()
+                if closing and closing.count(fence[0]) == len(closing) >= len(fence):
+                    yield from self._code_blocks(code, fence, limit)
+                    fence = None
+
+        yield from self._paragraph_blocks(paragraph, limit)
+        if fence is not None:
+            yield from self._code_blocks(code, fence, limit)
+
+    def _paragraph_blocks(self, lines, limit):
+        if not lines:
+            return
+
+        text = '\n'.join(lines)
+        size = self._size(text, limit)
+        if size <= limit:
+            yield text, size
+            return
+
+        # Break the paragraph between lines. Every line after the first also gains a line break ("<br />") tag.
+        piece = []
+        piece_size = 0
+        for line in lines:
+            for part in self._line_parts(line, limit - len('<br />\n')):
+                part_size = self._size(part, limit) + len('<br />\n')
+                if piece and piece_size + part_size > limit:
+                    yield '\n'.join(piece), piece_size
+                    piece = []
+                    piece_size = 0
+                piece.append(part)
+                piece_size += part_size
+
+        if piece:
+            yield '\n'.join(piece), piece_size
+
+    def _code_blocks(self, lines, fence, limit):
+        text = '\n'.join(lines)
+        size = self._size(text, limit)
+        if size <= limit:
+            yield text, size
+            return
+
+        # Break the code between lines, closing the block at the end of each piece and opening it again (with the
+        # same language) at the start of the next
+        opening = lines[0]
+        closed = len(lines) > 1 and lines[-1].strip().startswith(fence)
+        content = lines[1:-1] if closed else lines[1:]
+        overhead = max(len(opening) + len(fence) + 2, self._size('{}\n{}'.format(opening, fence), limit))
+
+        piece = []
+        piece_size = overhead
+        for line in content:
+            # Each line of code is followed by a line break
+            for part in self._line_parts(line, limit - overhead - 1, escape=True):
+                # Code is escaped rather than rendered, quotes included
+                part_size = len(html.escape(part)) + 1
+                if piece and piece_size + part_size > limit:
+                    yield '\n'.join([opening] + piece + [fence]), piece_size
+                    piece = []
+                    piece_size = overhead
+                piece.append(part)
+                piece_size += part_size
+
+        if piece:
+            yield '\n'.join([opening] + piece + [fence]), piece_size
+
+    def _line_parts(self, line, limit, escape=False):
+        """
+        Break a single line that is longer than limit on its own into parts
+        """
+        measure = (lambda part: len(html.escape(part))) if escape else (lambda part: self._size(part, limit))
+
+        while line:
+            length = min(len(line), limit)
+            size = measure(line[:length])
+            while length > 1 and size > limit:
+                length = max(1, min(length - 1, length * limit // size))
+                size = measure(line[:length])
+            yield line[:length]
+            line = line[length:]
+
+    def _convert(self, body):
+        md = getattr(self._local, 'markdown', None)
+        if md is None:
+            # Imported on first use as loading markdown and its extensions noticeably slows down the bot starting
+            from markdown import Markdown
+            md = self._local.markdown = Markdown(extensions=CISCO_SPARK_MARKDOWN_EXTENSIONS)
+        return md.reset().convert(body)
+
+
+class CiscoSparkCoalescer(object):
+    """
+    Buffers the outgoing messages to each destination for a short window and merges them into as few messages as the
+    size limit allows
+
+    A window starts with the first message buffered for a destination. When it expires the buffer is merged and handed
+    on to be sent. Once the buffered messages fill a whole message the full messages are sent straight away and the
+    rest stays buffered. Messages are merged in order, separated by a blank line so the markdown of each is kept, and a
+    message that leaves a code block open is never merged with the next.
+
+    Messages are handed on outside the lock so that sending to one destination never holds up the others. A single
+    thread at a time sends the messages of a destination, which keeps them in order.
+    """
+    def __init__(self, window, limit, send):
+
+        self._window = window
+        self._limit = limit
+        self._send = send
+        self._buffers = OrderedDict()
+        self._sending = {}
+        self._lock = threading.Condition()
+        self._thread = None
+        self.coalesced = 0
+
+    def put(self, destination, body):
+        """
+        Buffer a message
+
+        :param destination: The destination of the message
+        :param body: The message text
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='CiscoSparkCoalescer', daemon=True)
+                self._thread.start()
+
+            buffer = self._buffers.get(destination)
+            if buffer is None:
+                # Windows are all the same length so the buffers are kept in the order they expire
+                buffer = self._buffers[destination] = (time.monotonic() + self._window, [])
+                self._lock.notify()
+
+            bodies = buffer[1]
+            bodies.append(body)
+            if sum(len(body) + 2 for body in bodies) < self._limit:
+                return
+
+            # The last merged message stays buffered (for the rest of the window) while it still has room
+            merged = self.merge(bodies)
+            if len(merged[-1]) + 2 < self._limit:
+                bodies[:] = [merged.pop()]
+            else:
+                del self._buffers[destination]
+
+            sender = self._queue(destination, merged)
+
+        if sender:
+            self._deliver(destination)
+
+    def flush(self, destination=None):
+        """
+        Send the messages buffered for a destination, or for every destination if no destination is provided. When
+        every destination is flushed this waits until all the messages have been handed on.
+
+        :param destination: The destination
+        """
+        with self._lock:
+            if destination is None:
+                buffers = list(self._buffers.items())
+                self._buffers.clear()
+            elif destination in self._buffers:
+                buffers = [(destination, self._buffers.pop(destination))]
+            else:
+                buffers = []
+
+            senders = [buffered for buffered, (_, bodies) in buffers if self._queue(buffered, self.merge(bodies))]
+
+        for sender in senders:
+            self._deliver(sender)
+
+        if destination is None:
+            with self._lock:
+                self._lock.wait_for(lambda: not self._sending)
+
+    def _queue(self, destination, bodies):
+        """
+        Queue merged messages to be sent. Called holding the lock.
+
+        :return: True when the caller is to send the messages, False when another thread is already sending to the
+                 destination and will send them after its own
+        """
+        sending = self._sending.get(destination)
+        if sending is not None:
+            sending.extend(bodies)
+            return False
+
+        self._sending[destination] = deque(bodies)
+        return True
+
+    def _deliver(self, destination):
+        while True:
+            with self._lock:
+                sending = self._sending[destination]
+                if not sending:
+                    del self._sending[destination]
+                    self._lock.notify_all()
+                    return
+                body = sending.popleft()
+
+            try:
+                self._send(destination, body)
+            except Exception:
+                log.exception("Failed to send a coalesced message to {}".format(destination))
+
+    def merge(self, bodies):
+        """
+        Merge consecutive messages into messages no longer than the size limit
+
+        :param bodies: The message texts in the order they were sent
+        :return: A list of the merged message texts
+        """
+        merged = []
+        current = None
+
+        for body in bodies:
+            if current is not None and len(current) + len(body) + 2 <= self._limit:
+                current = '{}\n\n{}'.format(current, body)
+                self.coalesced += 1
+            else:
+                if current is not None:
+                    merged.append(current)
+                current = body
+
+            if self._open_code_block(current):
+                merged.append(current)
+                current = None
+
+        if current is not None:
+            merged.append(current)
+
+        return merged
+
+    @staticmethod
+    def _open_code_block(body):
+        fence = None
+        for line in body.split('\n'):
+            if fence is None:
+                match = CISCO_SPARK_CODE_FENCE.match(line)
+                if match:
+                    fence = match.group(1)
+            else:
+                closing = line.strip()
+                if closing and closing.count(fence[0]) == len(closing) >= len(fence):
+                    fence = None
+        return fence is not None
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._buffers:
+                    self._lock.wait()
+
+                destination, (expires, _) = next(iter(self._buffers.items()))
+                remaining = expires - time.monotonic()
+                if remaining > 0:
+                    self._lock.wait(remaining)
+                    continue
+
+            self.flush(destination)
+
+
+class CiscoSparkSendQueue(object):
+    """
+    Delivers outgoing messages using a pool of worker threads
+
+    Messages queued for the same destination (room or person) are delivered strictly in the order they were queued,
+    while messages for different destinations are delivered in parallel. Once the queue holds size messages any
+    further callers block until there is space available.
+    """
+    def __init__(self, workers, size):
+
+        self._workers = workers
+        self._size = size
+        self._pending = {}
+        self._ready = queue.Queue()
+        self._count = 0
+        self._lock = threading.Condition()
+        self._threads = []
+
+    @property
+    def depth(self):
+        """
+        The number of messages queued or in the process of being delivered
+        """
+        return self._count
+
+    def put(self, destination, job):
+        """
+        Queue a job for delivery, blocking while the queue is full
+
+        :param destination: The Spark ID of the room or person the job delivers to
+        :param job: A callable that delivers the message
+        """
+        with self._lock:
+            if not self._threads:
+                self._start()
+
+            while self._count >= self._size:
+                self._lock.wait()
+
+            self._count += 1
+
+            jobs = self._pending.get(destination)
+            if jobs is None:
+                # Nobody is working on this destination so make it available to the workers
+                self._pending[destination] = deque([job])
+                self._ready.put(destination)
+            else:
+                jobs.append(job)
+
+    def drain(self, timeout):
+        """
+        Wait for all queued messages to be delivered
+
+        :param timeout: The maximum number of seconds to wait
+        :return: True if the queue was drained before the timeout expired
+        """
+        deadline = time.monotonic() + timeout
+
+        with self._lock:
+            while self._count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log.warning("Timed out with {} outgoing messages still queued".format(self._count))
+                    return False
+                self._lock.wait(remaining)
+
+        return True
+
+    def _start(self):
+        for _ in range(self._workers):
+            thread = threading.Thread(target=self._run, name='CiscoSparkSendQueue', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            destination = self._ready.get()
+
+            with self._lock:
+                job = self._pending[destination].popleft()
+
+            try:
+                job()
+            except Exception:
+                log.exception("Failed to deliver message to {}".format(destination))
+
+            with self._lock:
+                self._count -= 1
+
+                # Only one worker handles a destination at a time which is what guarantees ordering. Hand the
+                # destination back to the pool (behind any other waiting destinations) if there is more to send.
+                if self._pending[destination]:
+                    self._ready.put(destination)
+                else:
+                    del self._pending[destination]
+
+                self._lock.notify_all()
+
+
+class CiscoSparkWebhookServer(object):
+    """
+    An asyncio HTTP server that receives the webhook events Cisco Spark posts to the bot
+
+    The signature of every request is verified against the webhook secret before the event is accepted onto a bounded
+    queue and acknowledged. A pool of worker threads then takes the events off the queue and passes them to the handler.
+    When the queue is full requests are rejected with a 503 so that Spark retries them later.
+    """
+    def __init__(self, host, port, path, secret, handler, workers, queue_size):
+
+        self._host = host
+        self._port = port
+        self._path = path
+        self._secret = secret.encode('utf-8')
+        self._handler = handler
+        self._workers = workers
+        self._events = queue.Queue(queue_size)
+        self._loop = None
+        self._server = None
+        self._connections = {}
+        self._threads = []
+
+    @property
+    def port(self):
+        """
+        The port the server is listening on (useful when the server was started on port 0)
+        """
+        return self._server.sockets[0].getsockname()[1]
+
+    @property
+    def depth(self):
+        """
+        The number of events waiting to be processed
+        """
+        return self._events.qsize()
+
+    def start(self):
+        """
+        Start listening for webhook events. Raises an exception if the server is unable to listen on the port.
+        Does nothing when the server is already started.
+        """
+        if self._loop:
+            return
+
+        loop = asyncio.new_event_loop()
+        try:
+            self._server = loop.run_until_complete(
+                asyncio.start_server(self._handle_connection, self._host, self._port)
+            )
+        except Exception:
+            loop.close()
+            raise
+
+        self._loop = loop
+
+        log.info("Listening for webhook events on {}:{}{}".format(self._host, self.port, self._path))
+
+        self._threads = [threading.Thread(target=self._loop.run_forever, name='CiscoSparkWebhookServer', daemon=True)]
+        self._threads += [threading.Thread(target=self._run, name='CiscoSparkWebhookWorker', daemon=True)
+                          for _ in range(self._workers)]
+
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=5):
+        """
+        Stop listening and wait for the workers to finish the events already accepted
+
+        :param timeout: The maximum number of seconds to wait for each thread
+        """
+        if not self._loop:
+            return
+
+        try:
+            asyncio.run_coroutine_threadsafe(self._close(timeout), self._loop).result(timeout)
+        except Exception:
+            log.exception("Failed to close the webhook server connections")
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+        for _ in range(self._workers):
+            self._events.put(None)
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+        self._loop.close()
+        self._loop = None
+        self._threads = []
+
+    async def _close(self, timeout):
+        self._server.close()
+
+        # Closing the open (keep-alive) connections ends their handlers
+        for writer in self._connections.values():
+            writer.close()
+
+        if self._connections:
+            await asyncio.wait(list(self._connections), timeout=timeout)
+
+    def accept(self, method, path, headers, body):
+        """
+        Validate a webhook request and queue its event for processing
+
+        :param method: The HTTP method
+        :param path: The HTTP request target
+        :param headers: A dictionary of HTTP headers with lower case names
+        :param body: The raw request body
+        :return: The HTTP status code to respond with
+        """
+        if path.split('?')[0] != self._path:
+            return HTTPStatus.NOT_FOUND
+
+        if method != 'POST':
+            return HTTPStatus.METHOD_NOT_ALLOWED
+
+        signature = hmac.new(self._secret, body, hashlib.sha1).hexdigest().encode('ascii')
+        if not hmac.compare_digest(signature, headers.get('x-spark-signature', '').encode('latin-1')):
+            log.warning("Rejected webhook event with an invalid signature")
+            return HTTPStatus.FORBIDDEN
+
+        try:
+            event = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST
+
+        try:
+            self._events.put_nowait(event)
+        except queue.Full:
+            log.warning("Webhook event queue is full, asking Spark to retry")
+            return HTTPStatus.SERVICE_UNAVAILABLE
+
+        return HTTPStatus.OK
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), CISCO_SPARK_WEBHOOK_IDLE_TIMEOUT)
+                if not request_line:
+                    break
+
+                method, path, version = request_line.decode('latin-1').split()
+
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), CISCO_SPARK_WEBHOOK_IDLE_TIMEOUT)
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > CISCO_SPARK_WEBHOOK_MAX_BODY:
+                    await self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, False)
+                    break
+
+                body = await asyncio.wait_for(reader.readexactly(length), CISCO_SPARK_WEBHOOK_IDLE_TIMEOUT)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                await self._respond(writer, self.accept(method, path, headers, body), keep_alive)
+                if not keep_alive:
+                    break
+
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+
+        finally:
+            del self._connections[task]
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status, keep_alive):
+        writer.write('HTTP/1.1 {} {}\r\nContent-Length: 0\r\nConnection: {}\r\n\r\n'.format(
+            status.value, status.phrase, 'keep-alive' if keep_alive else 'close').encode('latin-1'))
+        await writer.drain()
+
+    def _run(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+
+            try:
+                self._handler(event)
+            except Exception:
+                log.exception("Failed to process webhook event")
+
+
+class CiscoSparkMetrics(object):
+    """
+    Records the number, errors and latency (as a histogram) of every Spark API request per endpoint and room, and of
+    every webhook event dispatched to errbot, along with gauges such as queue depths and cache hit counts.
+
+    The metrics can be rendered as a markdown summary or in the Prometheus text exposition format.
+    """
+    def __init__(self):
+
+        self._series = {}
+        self._gauges = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, name, endpoint, seconds, error=False, room=None):
+        """
+        Record a timed operation
+
+        :param name: The metric name (e.g. api_request)
+        :param endpoint: The endpoint the operation was for (e.g. GET people)
+        :param seconds: How long the operation took
+        :param error: Whether the operation failed
+        :param room: The Spark id of the room the operation was for
+        """
+        key = (name, endpoint, room)
+
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0, 0, 0.0, [0] * len(CISCO_SPARK_METRICS_BUCKETS)]
+
+            series[0] += 1
+            series[1] += error
+            series[2] += seconds
+
+            buckets = series[3]
+            for index, bound in enumerate(CISCO_SPARK_METRICS_BUCKETS):
+                if seconds <= bound:
+                    buckets[index] += 1
+                    break
+
+    def gauge(self, name, labels, function):
+        """
+        Register a value that is read whenever the metrics are rendered
+
+        :param name: The metric name (e.g. queue_depth)
+        :param labels: A dictionary of labels
+        :param function: A callable returning the current value
+        """
+        self._gauges[(name, tuple(sorted(labels.items())))] = function
+
+    def install(self, api):
+        """
+        Time every request made by a CiscoSparkAPI session
+
+        :param api: The sparkapi.CiscoSparkAPI session
+        """
+        rest = api._session
+        rest.request = partial(self._timed_request, rest.request)
+
+    def _timed_request(self, send, method, url, erc, **kwargs):
+        start = time.perf_counter()
+        error = True
+
+        try:
+            response = send(method, url, erc, **kwargs)
+            error = False
+            return response
+        finally:
+            parameters = kwargs.get('json') or kwargs.get('params') or {}
+            self.observe('api_request', self.get_endpoint(method, url), time.perf_counter() - start, error,
+                         parameters.get('roomId'))
+
+    @staticmethod
+    def get_endpoint(method, url):
+        """
+        Name an endpoint using the HTTP method and the API resource (e.g. GET people)
+
+        :param method: The HTTP method
+        :param url: The relative or absolute URL of the request
+        :return: The endpoint name
+        """
+        parts = url.split('?')[0].split('/')
+        if '://' in url:
+            parts = parts[3:]
+        if parts and parts[0] == 'v1':
+            parts = parts[1:]
+        return '{} {}'.format(method, parts[0] if parts else '')
+
+    def snapshot(self):
+        """
+        :return: A copy of the recorded series keyed by (name, endpoint, room)
+        """
+        with self._lock:
+            return {key: (count, errors, total, list(buckets))
+                    for key, (count, errors, total, buckets) in self._series.items()}
+
+    @staticmethod
+    def percentile(buckets, count, fraction):
+        """
+        Estimate a percentile as the upper bound of the histogram bucket it falls in
 
-from errbot.errBot import ErrBot
-from errbot.backends.base import Message, Person, Room, RoomOccupant
+        :return: Seconds
+        """
+        target = count * fraction
+        seen = 0
+        for bound, bucket in zip(CISCO_SPARK_METRICS_BUCKETS, buckets):
+            seen += bucket
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        """
+        Render the metrics as markdown, combining the rooms of each endpoint
 
-import ciscosparkapi as sparkapi
+        :return: A markdown string
+        """
+        endpoints = OrderedDict()
+        for (name, endpoint, room), (count, errors, total, buckets) in sorted(self.snapshot().items(), key=str):
+            combined = endpoints.setdefault((name, endpoint), [0, 0, 0.0, [0] * len(CISCO_SPARK_METRICS_BUCKETS)])
+            combined[0] += count
+            combined[1] += errors
+            combined[2] += total
+            combined[3] = [a + b for a, b in zip(combined[3], buckets)]
+
+        lines = ['| Metric | Endpoint | Count | Errors | Avg (ms) | p50 (ms) | p99 (ms) |',
+                 '|--------|----------|-------|--------|----------|----------|----------|']
+        for (name, endpoint), (count, errors, total, buckets) in endpoints.items():
+            lines.append('| {} | {} | {} | {} | {:.1f} | <{:g} | <{:g} |'.format(
+                name, endpoint, count, errors, total / count * 1000,
+                self.percentile(buckets, count, 0.5) * 1000, self.percentile(buckets, count, 0.99) * 1000))
+
+        lines += ['', '| Gauge | Value |', '|-------|-------|']
+        for (name, labels), value in self._read_gauges():
+            lines.append('| {} | {:g} |'.format(' '.join([name] + ['{}={}'.format(*label) for label in labels]), value))
+
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """
+        Render the metrics in the Prometheus text exposition format
 
-log = logging.getLogger('errbot.backends.CiscoSpark')
+        :return: A string
+        """
+        lines = []
+        described = set()
+
+        for (name, endpoint, room), (count, errors, total, buckets) in sorted(self.snapshot().items(), key=str):
+            labels = 'endpoint="{}"'.format(endpoint) + (',room="{}"'.format(room) if room else '')
+
+            if name not in described:
+                described.add(name)
+                lines.append('# TYPE ciscospark_{}_seconds histogram'.format(name))
+                lines.append('# TYPE ciscospark_{}_errors_total counter'.format(name))
+
+            cumulative = 0
+            for bound, bucket in zip(CISCO_SPARK_METRICS_BUCKETS, buckets):
+                cumulative += bucket
+                lines.append('ciscospark_{}_seconds_bucket{{{},le="{}"}} {}'.format(
+                    name, labels, '+Inf' if bound == float('inf') else bound, cumulative))
+            lines.append('ciscospark_{}_seconds_sum{{{}}} {}'.format(name, labels, total))
+            lines.append('ciscospark_{}_seconds_count{{{}}} {}'.format(name, labels, count))
+            lines.append('ciscospark_{}_errors_total{{{}}} {}'.format(name, labels, errors))
+
+        for (name, labels), value in self._read_gauges():
+            if name not in described:
+                described.add(name)
+                lines.append('# TYPE ciscospark_{} gauge'.format(name))
+            labels = ','.join('{}="{}"'.format(*label) for label in labels)
+            lines.append('ciscospark_{}{} {}'.format(name, '{{{}}}'.format(labels) if labels else '', value))
+
+        return '\n'.join(lines) + '\n'
+
+    def _read_gauges(self):
+        for key, function in list(self._gauges.items()):
+            try:
+                yield key, function()
+            except Exception:
+                log.exception("Failed to read gauge {}".format(key[0]))
+
+
+class CiscoSparkMetricsServer(object):
+    """
+    Serves the metrics in the Prometheus text format on /metrics
+    """
+    def __init__(self, host, port, metrics):
 
-CISCO_SPARK_WEBHOOK_ID = 'CiscoSparkBackend'
-CISCO_SPARK_WEBHOOK_URI = 'errbot/spark'
-CISCO_SPARK_MESSAGE_SIZE_LIMIT = 7439
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(HTTPStatus.NOT_FOUND)
+                    return
+
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(HTTPStatus.OK)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug("Metrics request: " + format % args)
+
+        self._address = (host, port)
+        self._handler = Handler
+        self._server = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1] if self._server else self._address[1]
+
+    def start(self):
+        if self._thread:
+            return
+
+        self._server = ThreadingHTTPServer(self._address, self._handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='CiscoSparkMetricsServer', daemon=True)
+        self._thread.start()
+        log.info("Serving metrics on port {}".format(self.port))
+
+    def stop(self):
+        if self._thread:
+            self._server.shutdown()
+            self._thread.join()
+            self._server.server_close()
+            self._server = None
+            self._thread = None
+
+
+class CiscoSparkProfiler(object):
+    """
+    Profiles the dispatch of the next messages received by the backend and the messages it sends. While it runs the
+    stages of the hot paths (hydration, identity construction, storage, markdown rendering, API requests, sending and
+    each plugin) are timed and their exclusive time is reported. Nothing is instrumented until a profile is started,
+    so there is no overhead otherwise.
+
+    In trace mode the dispatch of each message is also traced with cProfile and the statistics are saved as a .prof
+    file. In sample mode the stacks of the threads working on a stage are sampled and saved in the folded format read
+    by flamegraph.pl and speedscope.
+    """
+    def __init__(self, bot, directory, interval=CISCO_SPARK_PROFILE_SAMPLE_INTERVAL):
+
+        self._bot = bot
+        self._directory = directory
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._trace_lock = threading.Lock()
+        self._local = threading.local()
+        self._patches = []
+        self._running = False
+        self._mode = None
+        self._limit = 0
+        self._messages = 0
+        self._started = None
+        self._stages = {}
+        self._stacks = {}
+        self._stats = None
+        self._samples = {}
+        self._sampler = None
+        self._stop_sampler = threading.Event()
+        self._report = None
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self, messages, mode=CISCO_SPARK_PROFILE_MODE_SAMPLE):
+        """
+        Profile the dispatch of a number of messages
+
+        :param messages: The number of messages to profile
+        :param mode: Either trace (cProfile) or sample (folded stacks)
+        """
+        if mode not in (CISCO_SPARK_PROFILE_MODE_TRACE, CISCO_SPARK_PROFILE_MODE_SAMPLE):
+            raise ValueError("The profile mode must be {} or {}".format(CISCO_SPARK_PROFILE_MODE_TRACE,
+                                                                        CISCO_SPARK_PROFILE_MODE_SAMPLE))
+
+        with self._lock:
+            if self._running:
+                raise RuntimeError("A profile of {} messages is already running".format(self._limit))
+
+            self._mode = mode
+            self._limit = messages
+            self._messages = 0
+            self._started = time.time()
+            self._stages = {}
+            self._stats = None
+            self._samples = {}
+            self._report = None
+            self._running = True
+
+        self._install()
+
+        if mode == CISCO_SPARK_PROFILE_MODE_SAMPLE:
+            self._stop_sampler.clear()
+            self._sampler = threading.Thread(target=self._sample, name='CiscoSparkProfiler', daemon=True)
+            self._sampler.start()
+
+        log.info("Profiling the dispatch of {} messages ({})".format(messages, mode))
+
+    def stop(self):
+        """
+        Stop profiling, save the cProfile statistics or the sampled stacks and build the report
+
+        :return: The report (or None when no profile is running)
+        """
+        with self._lock:
+            if not self._running:
+                return None
+            self._running = False
+
+        self._uninstall()
+
+        if self._sampler:
+            self._stop_sampler.set()
+            self._sampler.join()
+            self._sampler = None
+
+        path = self._save()
+        self._report = self._build_report(path)
+
+        log.info("Profiled the dispatch of {} messages{}".format(
+            self._messages, ', saved to {}'.format(path) if path else ''))
+        return self._report
+
+    def report(self):
+        """
+        :return: The report of the last profile, or the progress of the running profile
+        """
+        if self._running:
+            return "Profiling ({}): {} of {} messages dispatched".format(self._mode, self._messages, self._limit)
+        return self._report or "No profile has been run. Start one with `spark profile start [messages] [{}|{}]`"\
+            .format(CISCO_SPARK_PROFILE_MODE_SAMPLE, CISCO_SPARK_PROFILE_MODE_TRACE)
+
+    # Instrumentation
+
+    def _install(self):
+        bot = self._bot
+        rest = bot.session._session
+
+        self._patch(bot, 'process_message_event', self._dispatch(bot.process_message_event))
+        self._patch(bot, 'hydrate_message_event', self._timed('hydrate', bot.hydrate_message_event))
+        self._patch(bot, '_deliver_message', self._timed('send', bot._deliver_message))
+        self._patch(bot, '_execute_and_send', self._command(bot._execute_and_send))
+        self._patch(bot._markdown, 'render', self._timed('render', bot._markdown.render))
+        self._patch(rest, 'request', self._timed('api', rest.request))
+        self._patch(CiscoSparkPerson, '__init__', self._timed('identity', CiscoSparkPerson.__init__))
+
+        for name in ('recall', 'recall_key', 'remember', 'forget'):
+            self._patch(bot, name, self._timed('storage', getattr(bot, name)))
+
+        for plugin in bot.plugin_manager.get_all_active_plugin_objects_ordered():
+            self._patch(plugin, 'callback_message',
+                        self._timed('plugin {}'.format(plugin.name), plugin.callback_message))
+
+    def _patch(self, target, name, function):
+        self._patches.append((target, name, target.__dict__.get(name, CISCO_SPARK_PROFILE_UNSET)))
+        setattr(target, name, function)
+
+    def _uninstall(self):
+        while self._patches:
+            target, name, original = self._patches.pop()
+            if original is CISCO_SPARK_PROFILE_UNSET:
+                delattr(target, name)
+            else:
+                setattr(target, name, original)
+
+    def _timed(self, stage, function):
+
+        @wraps(function)
+        def timed(*args, **kwargs):
+            self._enter(stage)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._exit()
+
+        return timed
+
+    def _command(self, function):
+
+        def execute(cmd, args, match, msg, template_name=None):
+            commands = self._bot.re_commands if match else self._bot.commands
+            method = commands.get(cmd)
+            plugin = getattr(getattr(method, '__self__', None), 'name', cmd)
+
+            self._enter('plugin {}'.format(plugin))
+            try:
+                return function(cmd, args, match, msg, template_name)
+            finally:
+                self._exit()
+
+        return execute
+
+    def _dispatch(self, function):
+
+        def dispatch(data):
+            profile = None
+            # Only one message is traced at a time, as cProfile can only be enabled once per process on newer Pythons
+            if self._mode == CISCO_SPARK_PROFILE_MODE_TRACE and self._trace_lock.acquire(blocking=False):
+                profile = cProfile.Profile()
+
+            self._enter('dispatch')
+            try:
+                if profile:
+                    profile.enable()
+                return function(data)
+            finally:
+                if profile:
+                    profile.disable()
+                    self._add_trace(profile)
+                    self._trace_lock.release()
+                self._exit()
+                self._dispatched()
+
+        return dispatch
+
+    def _enter(self, stage):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+            self._stacks[threading.get_ident()] = stack
+        stack.append([stage, time.perf_counter(), 0.0])
+
+    def _exit(self):
+        stack = self._local.stack
+        stage, start, children = stack.pop()
+        elapsed = time.perf_counter() - start
+
+        # Time spent in nested stages is only counted against the nested stage
+        if stack:
+            stack[-1][2] += elapsed
+
+        with self._lock:
+            if not self._running:
+                return
+            totals = self._stages.get(stage)
+            if totals is None:
+                totals = self._stages[stage] = [0, 0.0]
+            totals[0] += 1
+            totals[1] += elapsed - children
+
+    def _dispatched(self):
+        with self._lock:
+            if not self._running:
+                return
+            self._messages += 1
+            finished = self._messages >= self._limit
+
+        if finished:
+            self.stop()
+
+    def _add_trace(self, profile):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    def _sample(self):
+        own = threading.get_ident()
+
+        while not self._stop_sampler.wait(self._interval):
+            frames = sys._current_frames()
+
+            for thread, stack in list(self._stacks.items()):
+                frame = frames.get(thread)
+                if thread == own or not stack or frame is None:
+                    continue
+
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+
+                folded = ';'.join(reversed(names))
+                self._samples[folded] = self._samples.get(folded, 0) + 1
+
+    # Output
+
+    def _save(self):
+        if self._stats is None and not self._samples:
+            return None
+
+        os.makedirs(self._directory, exist_ok=True)
+        name = os.path.join(self._directory, 'spark-profile-{}'.format(time.strftime('%Y%m%d-%H%M%S',
+                                                                                     time.localtime(self._started))))
+
+        if self._stats is not None:
+            path = name + '.prof'
+            self._stats.dump_stats(path)
+            return path
+
+        path = name + '.folded'
+        with open(path, 'w') as file:
+            for folded, count in sorted(self._samples.items()):
+                file.write('{} {}\n'.format(folded, count))
+        return path
+
+    def _build_report(self, path):
+        total = sum(seconds for _, seconds in self._stages.values()) or 1
+
+        lines = ['Profiled the dispatch of {} messages ({})'.format(self._messages, self._mode), '',
+                 '| Stage | Calls | Total (ms) | Avg (ms) | Share |',
+                 '|-------|-------|------------|----------|-------|']
+        for stage, (calls, seconds) in sorted(self._stages.items(), key=lambda item: -item[1][1]):
+            lines.append('| {} | {} | {:.1f} | {:.2f} | {:.0f}% |'.format(
+                stage, calls, seconds * 1000, seconds / calls * 1000, seconds / total * 100))
+
+        if path:
+            lines += ['', 'Saved to `{}`'.format(path)]
+
+        return '\n'.join(lines)
+
+
+class CiscoSparkCommands(object):
+    """
+    Admin commands provided by the backend itself
+    """
+    name = 'CiscoSpark'
+    # The help command describes each class of commands with the documentation errbot gives to plugins
+    __errdoc__ = 'Admin commands provided by the Cisco Spark backend'
+
+    def __init__(self, bot):
+        self._bot = bot
+
+    @botcmd(admin_only=True)
+    def spark_metrics(self, msg, args):
+        """
+        Show the Cisco Spark API and dispatch metrics of the backend
+        """
+        if not self._bot.metrics:
+            return "Metrics are disabled. Set METRICS to True in the BOT_IDENTITY of config.py to enable them."
+        return self._bot.metrics.summary()
+
+    @botcmd(admin_only=True)
+    def spark_profile(self, msg, args):
+        """
+        Profile the dispatch of messages: spark profile start [messages] [sample|trace], spark profile stop, or
+        spark profile to show the report
+        """
+        profiler = self._bot.profiler
+        args = args.split()
+        action = args.pop(0) if args else None
+
+        if action == 'start':
+            try:
+                messages = int(args[0]) if args else CISCO_SPARK_PROFILE_MESSAGES
+                profiler.start(messages, *args[1:2])
+            except (ValueError, RuntimeError) as error:
+                return str(error)
+            return "Profiling the dispatch of the next {} messages".format(messages)
+
+        if action == 'stop':
+            return profiler.stop() or "No profile is running"
+
+        return profiler.report()
 
 
 class CiscoSparkMessage(Message):
@@ -32,83 +2462,129 @@ class CiscoSparkMessage(Message):
 class CiscoSparkPerson(Person):
     """
     A Cisco Spark Person
+
+    Only the fields used by the backend are kept from the Spark JSON and the ID is interned, so the many copies of a
+    person held as occupants of large rooms stay small and share a single ID string.
     """
+    __slots__ = ('_bot', '_id', '_emails', '_display_name', '_created', '_avatar')
+
     def __init__(self, bot, attributes={}):
 
         self._bot = bot
 
-        if isinstance(attributes, sparkapi.Person):
-            self._spark_person = attributes
+        if isinstance(attributes, CiscoSparkPerson):
+            self._copy_details(attributes)
         else:
-            self._spark_person = sparkapi.Person(attributes)
+            self._set_details(attributes._json_data if isinstance(attributes, sparkapi.Person) else attributes)
+
+    def _set_details(self, data):
+        self._id = intern_id(data.get('id'))
+        self._emails = tuple(data['emails']) if 'emails' in data else None
+        self._display_name = data.get('displayName')
+        self._created = data.get('created')
+        self._avatar = data.get('avatar')
+
+    def _copy_details(self, other):
+        self._id = other._id
+        self._emails = other._emails
+        self._display_name = other._display_name
+        self._created = other._created
+        self._avatar = other._avatar
 
     @property
     def id(self):
-        return self._spark_person.id
+        return self._id
 
     @id.setter
     def id(self, val):
-        self._spark_person._json_data['id'] = val
+        self._id = intern_id(val)
 
     @property
     def emails(self):
-        return self._spark_person.emails
+        self._details()
+        return list(self._emails or ())
 
     @property
     def displayName(self):
-        return self._spark_person.displayName
+        self._details()
+        return self._display_name
 
     @property
     def created(self):
-        return self._spark_person.created
+        self._details()
+        return self._created
 
     @property
     def avatar(self):
-        return self._spark_person.avatar
+        self._details()
+        return self._avatar
+
+    @property
+    def is_stub(self):
+        """
+        A person created from just an ID whose details have not been loaded yet
+        """
+        return self._emails is None and self._display_name is None
+
+    def _details(self):
+        """
+        Make sure the details of the person are available. The first time the details of a stub are needed they are
+        loaded through the backend, so concurrent lookups of the same person share a single request and fill the
+        person cache. A person that fails to load is not requested again for PERSON_FAILURE_TTL seconds and its
+        details are left empty.
+        """
+        if self.is_stub and self._id and not self._bot.person_failures.get(self._id):
+            try:
+                self._copy_details(self._bot.get_person_using_id(self._id))
+            except Exception:
+                self._bot.person_failures.set(self._id, True)
+                log.exception("Failed to load the details of person {}".format(self._id))
 
     @staticmethod
     def build_from_json(obj):
         return CiscoSparkPerson(sparkapi.Person(obj))
 
     @classmethod
-    def find_using_email(cls, session, value):
+    def find_using_email(cls, backend, value):
         """
         Return the FIRST Cisco Spark person found when searching using an email address
 
-        :param session: The CiscoSparkAPI session handle
+        :param backend: The CiscoSparkBackend
         :param value: the value to search for
         :return: A CiscoSparkPerson
         """
-        for person in session.people.list(email=value):
-            return CiscoSparkPerson(person)
-        return CiscoSparkPerson()
+        for person in backend.session.people.list(email=value):
+            return CiscoSparkPerson(backend, person)
+        return CiscoSparkPerson(backend)
 
     @classmethod
-    def find_using_name(cls, session, value):
+    def find_using_name(cls, backend, value):
         """
         Return the FIRST Cisco Spark person found when searching using the display name
 
-        :param session: The CiscoSparkAPI session handle
+        :param backend: The CiscoSparkBackend
         :param value: the value to search for
         :return: A CiscoSparkPerson
         """
-        for person in session.people.list(displayName=value):
-            return CiscoSparkPerson(person)
-        return CiscoSparkPerson()
+        for person in backend.directory.find_using_name(value):
+            return person
+        for person in backend.session.people.list(displayName=value):
+            return CiscoSparkPerson(backend, person)
+        return CiscoSparkPerson(backend)
 
     @classmethod
-    def get_using_id(cls, session, value):
+    def get_using_id(cls, backend, value):
         """
         Return a Cisco Spark person when searching using an ID
 
-        :param session: The CiscoSparkAPI session handle
+        :param backend: The CiscoSparkBackend
         :param value: the Spark ID
         :return: A CiscoSparkPerson
         """
-        return CiscoSparkPerson(session.people.get(value))
+        return CiscoSparkPerson(backend, backend.session.people.get(value))
 
     def load(self):
-        self._spark_person = self._bot.session.Person(self.id)
+        self._set_details(self._bot.session.people.get(self.id)._json_data)
 
     # Err API
 
@@ -128,8 +2604,16 @@ class CiscoSparkPerson(Person):
     def fullname(self):
         return self.displayName
 
+    def to_dict(self):
+        """
+        The details of the person as a dictionary that can be used to build the person again
+        """
+        return {'id': self._id, 'emails': list(self._emails or ()), 'displayName': self._display_name,
+                'created': self._created, 'avatar': self._avatar}
+
     def json(self):
-        return self._spark_person.json()
+        self._details()
+        return json.dumps(self.to_dict())
 
     def __eq__(self, other):
         return str(self) == str(other)
@@ -143,8 +2627,10 @@ class CiscoSparkPerson(Person):
 
 class CiscoSparkRoomOccupant(CiscoSparkPerson, RoomOccupant):
     """
-    A Cisco Spark Person that Occupies a Cisco Spark Room
+    A Cisco Spark Person that Occupies a Cisco Spark Room. Occupants reference the (shared) room they occupy.
     """
+    __slots__ = ('_room',)
+
     def __init__(self, bot, room={}, person={}):
 
         if isinstance(room, CiscoSparkRoom):
@@ -152,10 +2638,7 @@ class CiscoSparkRoomOccupant(CiscoSparkPerson, RoomOccupant):
         else:
             self._room = CiscoSparkRoom(bot, room)
 
-        if isinstance(person, CiscoSparkPerson):
-            self._spark_person = person
-        else:
-            super().__init__(person)
+        super().__init__(bot, person)
 
     @property
     def room(self):
@@ -166,77 +2649,211 @@ class CiscoSparkRoom(Room):
     """
     A Cisco Spark Room
     """
+    __slots__ = ('_bot', '_webhook', '_members', '_member_emails', '_members_lock', '_id', '_title', '_type',
+                 '_created', '_last_activity', '_sip_address')
 
     def __init__(self, bot, val={}):
 
         self._bot = bot
         self._webhook = None
-        self._occupants = []
 
-        if isinstance(val, sparkapi.Room):
-            self._spark_room = val
-        else:
-            self._spark_room = sparkapi.Room(val)
+        # The occupants of the room indexed by person id and email. None until the memberships are loaded.
+        self._members = None
+        self._member_emails = {}
+        self._members_lock = threading.Lock()
+
+        self._set_details(val._json_data if isinstance(val, sparkapi.Room) else val)
+
+    def _set_details(self, data):
+        self._id = intern_id(data.get('id'))
+        self._title = data.get('title')
+        self._type = data.get('type')
+        self._created = data.get('created')
+        self._last_activity = data.get('lastActivity')
+        self._sip_address = data.get('sipAddress')
 
     @property
     def sipAddress(self):
-        return self._spark_room.sipAddress
+        self._details()
+        return self._sip_address
 
     @property
     def created(self):
-        return self._spark_room.created
+        self._details()
+        return self._created
 
     @property
     def id(self):
-        return self._spark_room.id
+        return self._id
 
     @id.setter
     def id(self, val):
-        self._spark_room._json_data['id'] = val
+        self._id = intern_id(val)
 
     @property
     def title(self):
-        return self._spark_room.title
+        self._details()
+        return self._title
+
+    @property
+    def type(self):
+        self._details()
+        return self._type
+
+    @property
+    def is_stub(self):
+        """
+        A room created from just an ID whose details have not been loaded yet
+        """
+        return self._title is None and self._type is None
+
+    def _details(self):
+        """
+        Make sure the details of the room are available. The first time the details of a stub are needed they are
+        loaded through the backend, so concurrent lookups of the same room share a single request and fill the room
+        cache. A room that fails to load is not requested again for ROOM_FAILURE_TTL seconds and its details are left
+        empty.
+        """
+        if self.is_stub and self._id and not self._bot.room_failures.get(self._id):
+            try:
+                room = self._bot.get_room_using_id(self._id)
+                self._title, self._type, self._created = room._title, room._type, room._created
+                self._last_activity, self._sip_address = room._last_activity, room._sip_address
+            except Exception:
+                self._bot.room_failures.set(self._id, True)
+                log.exception("Failed to load the details of room {}".format(self._id))
 
     @classmethod
     def get_using_id(cls, backend, val):
         return CiscoSparkRoom(backend, backend.session.rooms.get(val))
 
     def update_occupants(self):
+        """
+        Reload every occupant of the room from Spark
+        """
+        for _ in self._load_occupants():
+            pass
+
+    def iter_occupants(self):
+        """
+        Generate the occupants of the room. The first time the memberships are streamed from Spark one page at a time
+        (and indexed as they arrive), after that the occupants are generated from the index.
+
+        :return: A generator of CiscoSparkRoomOccupant
+        """
+        with self._members_lock:
+            members = None if self._members is None else list(self._members.values())
+
+        if members is None:
+            yield from self._load_occupants()
+        else:
+            yield from members
+
+    def is_member(self, person):
+        """
+        Check whether a person is an occupant of the room
+
+        :param person: The Spark id or email address of the person
+        :return: Boolean
+        """
+        if self._members is None:
+            self.update_occupants()
+
+        with self._members_lock:
+            return person in self._members or person.lower() in self._member_emails
+
+    def membership_created(self, membership):
+        """
+        Add (or update) an occupant using the data of a memberships/created (or updated) webhook event
+
+        :param membership: The membership data
+        """
+        with self._members_lock:
+            if self._members is not None:
+                self._index_membership(self._members, self._member_emails, membership)
+
+    def membership_deleted(self, membership):
+        """
+        Remove an occupant using the data of a memberships/deleted webhook event
+
+        :param membership: The membership data
+        """
+        with self._members_lock:
+            if self._members is not None:
+                occupant = self._members.pop(membership.get('personId'), None)
+                for email in occupant.emails if occupant else []:
+                    self._member_emails.pop(email.lower(), None)
 
-        log.debug("Updating occupants for room {} ({})".format(self.title, self.id))
-        self._occupants.clear()
+    def _load_occupants(self):
 
-        for member in self._bot.session.memberships.get(self.id):
-            self._occupants.append(CiscoSparkRoomOccupant(self.id, membership=member))
+        log.debug("Loading occupants for room {}".format(self.id))
+        members = {}
+        emails = {}
 
-        log.debug("Total occupants for room {} ({}) is {} ".format(self.title, self.id, len(self._occupants)))
+        for membership in self._bot.session.memberships.list(roomId=self.id, max=CISCO_SPARK_MEMBERSHIP_PAGE_SIZE):
+            yield self._index_membership(members, emails, membership._json_data)
+
+        with self._members_lock:
+            self._members = members
+            self._member_emails = emails
+
+        log.debug("Total occupants for room {} is {} ".format(self.id, len(members)))
+
+    def _index_membership(self, members, emails, membership):
+        email = membership.get('personEmail')
+        occupant = CiscoSparkRoomOccupant(self._bot, room=self, person={
+            'id': membership.get('personId'),
+            'emails': [email] if email else [],
+            'displayName': membership.get('personDisplayName')
+        })
+
+        members[occupant.id] = occupant
+        if email:
+            # Emails are nearly always lower case already, in which case the same string is shared by the index
+            emails[email if email.islower() else email.lower()] = occupant.id
+
+        return occupant
 
     def load(self):
-        self._spark_room = self._bot.session.Room(self.id)
+        self._set_details(self._bot.session.rooms.get(self.id)._json_data)
+
+    def to_dict(self):
+        """
+        The details of the room as a dictionary that can be used to build the room again
+        """
+        return {'id': self._id, 'title': self._title, 'type': self._type, 'created': self._created,
+                'lastActivity': self._last_activity, 'sipAddress': self._sip_address}
 
     # Errbot API
 
     def join(self, username=None, password=None):
 
-        log.debug("Joining room {} ({})".format(self.title, self.id))
+        if not self._bot.owns_room(self.id):
+            log.debug("Room {} is owned by another shard".format(self.id))
+            return
+
+        # Only the room id is logged so that joining a room does not load its details
+        if self.id in self._bot.room_webhooks:
+            log.debug("Room {} has already been joined".format(self.id))
+            return
+
+        log.debug("Joining room {}".format(self.id))
 
         try:
             self._bot.session.memberships.create(self.id, self._bot.bot_identifier.id)
-            log.debug("{} is NOW a member of {} ({})".format(self._bot.bot_identifier.displayName, self.title, self.id))
+            log.debug("{} is NOW a member of {}".format(self._bot.bot_identifier.displayName, self.id))
 
         except sparkapi.exceptions.SparkApiError as error:
             # API now returning a 403 when trying to add user to a direct conversation and they are already in the
             # conversation. For groups if the user is already a member a 409 is returned.
             if error.response.status_code == 403 or error.response.status_code == 409:
-                log.debug("{} is already a member of {} ({})".format(self._bot.bot_identifier.displayName, self.title,
-                                                                     self.id))
+                log.debug("{} is already a member of {}".format(self._bot.bot_identifier.displayName, self.id))
             else:
-                log.exception("HTTP Exception: Failed to join room {} ({})".format(self.title, self.id))
+                log.exception("HTTP Exception: Failed to join room {}".format(self.id))
                 return
 
         except Exception:
-            log.exception("Failed to join room {} ({})".format(self.title, self.id))
+            log.exception("Failed to join room {}".format(self.id))
             return
 
         # When errbot joins rooms we need to create a new webhook for the integration
@@ -244,15 +2861,18 @@ class CiscoSparkRoom(Room):
 
     def webhook_create(self):
         """
-        Create a webhook that listens to new messages for this room (id)
+        Create the webhooks that listen to new messages and membership changes for this room (id)
         """
         self._webhook = self._bot.create_webhook(filter="roomId={}".format(self.id))
+        self._bot.room_webhooks[self.id] = self._webhook
+        self._bot.create_event_webhooks(self.id)
 
     def webhook_delete(self):
         """
-        Delete the webhook for this room
+        Delete the webhooks for this room
         """
-        self._bot.delete_webhook(self._webhook)
+        self._bot.delete_webhook(self._bot.room_webhooks.pop(self.id, self._webhook))
+        self._bot.delete_event_webhooks(self.id)
 
     def leave(self, reason=None):
         log.debug("Leave room yet to be implemented")  # TODO
@@ -281,7 +2901,9 @@ class CiscoSparkRoom(Room):
 
     @property
     def occupants(self, session=None):
-        return self._occupants
+        if self._members is None:
+            self.update_occupants()
+        return list(self._members.values())
 
     def invite(self, *args) -> None:
         log.debug("Invite room yet to be implemented")  # TODO
@@ -331,6 +2953,32 @@ class CiscoSparkBackend(ErrBot):
 
         log.debug("Room presence: {}".format(self._bot_rooms))
 
+        # Either register a webhook per room or a single unfiltered (firehose) webhook where events are filtered locally
+
+        self._webhook_mode = bot_identity.get('WEBHOOK_MODE', CISCO_SPARK_WEBHOOK_MODE_ROOM)
+        if self._webhook_mode not in (CISCO_SPARK_WEBHOOK_MODE_ROOM, CISCO_SPARK_WEBHOOK_MODE_FIREHOSE):
+            log.fatal('WEBHOOK_MODE in the BOT_IDENTITY of config.py must be either "{}" or "{}".'.format(
+                CISCO_SPARK_WEBHOOK_MODE_ROOM, CISCO_SPARK_WEBHOOK_MODE_FIREHOSE))
+            sys.exit(1)
+
+        # In a sharded deployment each worker process owns the rooms whose ids hash to its SHARD_INDEX, and only
+        # joins and registers webhooks for those rooms
+
+        self._shard_count = bot_identity.get('SHARD_COUNT', CISCO_SPARK_SHARD_COUNT)
+        self._shard_index = bot_identity.get('SHARD_INDEX', CISCO_SPARK_SHARD_INDEX)
+        if not 0 <= self._shard_index < self._shard_count:
+            log.fatal('SHARD_INDEX in the BOT_IDENTITY of config.py must be between 0 and SHARD_COUNT - 1.')
+            sys.exit(1)
+
+        if self._shard_count > 1:
+            self._bot_rooms = tuple(room for room in self._bot_rooms if self.owns_room(room))
+            self._webhook_name = '{}-{}-{}'.format(CISCO_SPARK_WEBHOOK_ID, self._shard_index, self._shard_count)
+            log.info("Shard {} of {} owns {} rooms".format(self._shard_index, self._shard_count, len(self._bot_rooms)))
+        else:
+            self._webhook_name = CISCO_SPARK_WEBHOOK_ID
+
+        self._allowed_rooms = frozenset(self._bot_rooms)
+
         # Adjust message size limit to cater for the non-standard size limit
 
         if config.MESSAGE_SIZE_LIMIT > CISCO_SPARK_MESSAGE_SIZE_LIMIT:
@@ -340,34 +2988,380 @@ class CiscoSparkBackend(ErrBot):
             )
             config.MESSAGE_SIZE_LIMIT = CISCO_SPARK_MESSAGE_SIZE_LIMIT
 
-        # Build the complete path to the Webhook URI
+        # Build the complete path to the Webhook URI
+
+        if self._webhook_destination[len(self._webhook_destination) - 1] != '/':
+            self._webhook_destination += '/'
+
+        self._webhook_destination += CISCO_SPARK_WEBHOOK_URI
+
+        # Cache people so that repeated lookups of the same sender do not hit the Spark API
+
+        self._person_cache = CiscoSparkPersonCache(
+            bot_identity.get('PERSON_CACHE_SIZE', CISCO_SPARK_PERSON_CACHE_SIZE),
+            bot_identity.get('PERSON_CACHE_TTL', CISCO_SPARK_PERSON_CACHE_TTL)
+        )
+
+        # Remember the people that could not be loaded (e.g. deleted users) so they are not requested again each time
+        # one of their details is read
+
+        self._person_failures = CiscoSparkCache(
+            bot_identity.get('PERSON_CACHE_SIZE', CISCO_SPARK_PERSON_CACHE_SIZE),
+            bot_identity.get('PERSON_FAILURE_TTL', CISCO_SPARK_PERSON_FAILURE_TTL)
+        )
+
+        # Cache rooms so that room scoped commands do not hit the Spark API every time the room is queried
+
+        self._room_cache = CiscoSparkCache(
+            bot_identity.get('ROOM_CACHE_SIZE', CISCO_SPARK_ROOM_CACHE_SIZE),
+            bot_identity.get('ROOM_CACHE_TTL', CISCO_SPARK_ROOM_CACHE_TTL)
+        )
+
+        # As for people, rooms that could not be loaded are not requested again each time one of their details is read
+
+        self._room_failures = CiscoSparkCache(
+            bot_identity.get('ROOM_CACHE_SIZE', CISCO_SPARK_ROOM_CACHE_SIZE),
+            bot_identity.get('ROOM_FAILURE_TTL', CISCO_SPARK_ROOM_FAILURE_TTL)
+        )
+
+        # Deliver outgoing messages from a pool of workers so that plugins are not blocked by the Spark API. Setting
+        # SEND_WORKERS to 0 delivers messages synchronously.
+
+        send_workers = bot_identity.get('SEND_WORKERS', CISCO_SPARK_SEND_WORKERS)
+        self._send_queue = CiscoSparkSendQueue(
+            send_workers,
+            bot_identity.get('SEND_QUEUE_SIZE', CISCO_SPARK_SEND_QUEUE_SIZE)
+        ) if send_workers else None
+        self._send_drain_timeout = bot_identity.get('SEND_DRAIN_TIMEOUT', CISCO_SPARK_SEND_DRAIN_TIMEOUT)
+        self._file_upload_limit = bot_identity.get('FILE_UPLOAD_LIMIT', CISCO_SPARK_FILE_UPLOAD_LIMIT)
+        self._file_download_limit = bot_identity.get('FILE_DOWNLOAD_LIMIT', CISCO_SPARK_FILE_DOWNLOAD_LIMIT)
+
+        # Optionally merge the messages sent to a destination in quick succession into as few messages as possible
+
+        coalesce_window = bot_identity.get('COALESCE_WINDOW', CISCO_SPARK_COALESCE_WINDOW)
+        self._coalescer = CiscoSparkCoalescer(
+            coalesce_window,
+            config.MESSAGE_SIZE_LIMIT,
+            self.queue_message
+        ) if coalesce_window else None
+
+        self._markdown = CiscoSparkMarkdown(bot_identity.get('MARKDOWN_CACHE_SIZE', CISCO_SPARK_MARKDOWN_CACHE_SIZE))
+
+        # The messages webhook registered for each joined room, keyed by room id, and the memberships and rooms
+        # webhooks that keep the cached rooms current, keyed by (resource, event, room id or None when unfiltered)
+
+        self._room_webhooks = {}
+        self._event_webhooks = {}
+        self._startup_workers = bot_identity.get('STARTUP_WORKERS', CISCO_SPARK_STARTUP_WORKERS)
+
+        # The directory behind rooms(), contacts() and name lookups is loaded in the background on connecting and
+        # refreshed every DIRECTORY_REFRESH seconds
+
+        self._directory = CiscoSparkDirectory(
+            self,
+            bot_identity.get('DIRECTORY_REFRESH', CISCO_SPARK_DIRECTORY_REFRESH),
+            self._startup_workers
+        )
+
+        # Optionally receive webhook events directly rather than relying on the err-webhook-cisco-spark plugin
+
+        webhook_port = bot_identity.get('WEBHOOK_LISTEN_PORT', None)
+        webhook_workers = bot_identity.get('WEBHOOK_WORKERS', CISCO_SPARK_WEBHOOK_WORKERS) if webhook_port is not None \
+            else 0
+        self._webhook_server = CiscoSparkWebhookServer(
+            bot_identity.get('WEBHOOK_LISTEN_HOST', CISCO_SPARK_WEBHOOK_LISTEN_HOST),
+            webhook_port,
+            '/' + CISCO_SPARK_WEBHOOK_URI,
+            self._webhook_secret,
+            self.process_webhook_event,
+            webhook_workers,
+            bot_identity.get('WEBHOOK_QUEUE_SIZE', CISCO_SPARK_WEBHOOK_QUEUE_SIZE)
+        ) if webhook_port is not None else None
+
+        # Concurrent lookups of the same person or room share a single request, and the details of incoming
+        # messages are loaded in parallel
+
+        self._single_flight = CiscoSparkSingleFlight()
+        hydration_workers = bot_identity.get('HYDRATION_WORKERS', CISCO_SPARK_HYDRATION_WORKERS)
+        self._hydration_pool = ThreadPoolExecutor(max_workers=hydration_workers)
+
+        # Keep the remember/recall dictionaries in memory and write them back to storage periodically, or, when
+        # SHARED_STORE is set, keep them in a database shared with the other worker processes
+
+        shared_store = bot_identity.get('SHARED_STORE', None)
+        database = CiscoSparkSQLite(shared_store) if shared_store else None
+
+        if database:
+            self._store = CiscoSparkSharedStore(database)
+        else:
+            self._store = CiscoSparkWriteBackStore(
+                self,
+                bot_identity.get('STORAGE_FLUSH_INTERVAL', CISCO_SPARK_STORAGE_FLUSH_INTERVAL),
+                bot_identity.get('STORAGE_CACHE_SIZE', CISCO_SPARK_STORAGE_CACHE_SIZE)
+            )
+
+        # Spark retries webhook deliveries, remember the recent message ids so the retries are dropped
+
+        if database:
+            self._dedupe = CiscoSparkSharedDedupe(
+                database,
+                bot_identity.get('DEDUPE_WINDOW', CISCO_SPARK_DEDUPE_WINDOW)
+            )
+        else:
+            self._dedupe = CiscoSparkDedupeWindow(
+                bot_identity.get('DEDUPE_WINDOW', CISCO_SPARK_DEDUPE_WINDOW),
+                bot_identity.get('DEDUPE_SIZE', CISCO_SPARK_DEDUPE_SIZE)
+            )
+
+        # Optionally instrument the Spark API calls and the dispatch of webhook events
+
+        self._metrics = CiscoSparkMetrics() if bot_identity.get('METRICS', False) else None
+
+        metrics_port = bot_identity.get('METRICS_LISTEN_PORT', None)
+        self._metrics_server = CiscoSparkMetricsServer(
+            bot_identity.get('METRICS_LISTEN_HOST', CISCO_SPARK_METRICS_LISTEN_HOST),
+            metrics_port,
+            self._metrics
+        ) if self._metrics and metrics_port is not None else None
+
+        # Initialize the CiscoSparkAPI session used to manage the Spark integration. By default the HTTP connection
+        # pool is sized so that every worker that can call the Spark API concurrently has a connection to reuse.
+
+        log.debug("Fetching and building identifier for the bot itself.")
+        self._session = sparkapi.CiscoSparkAPI(
+            self._bot_token,
+            base_url=bot_identity.get('API_BASE_URL', sparkapi.DEFAULT_BASE_URL),
+            single_request_timeout=bot_identity.get('HTTP_TIMEOUT', CISCO_SPARK_HTTP_TIMEOUT)
+        )
+
+        self.configure_http_pool(
+            bot_identity.get('HTTP_POOL_SIZE', max(send_workers + hydration_workers + webhook_workers,
+                                                   self._startup_workers)),
+            bot_identity.get('HTTP_POOL_HOSTS', CISCO_SPARK_HTTP_POOL_HOSTS),
+            bot_identity.get('HTTP_POOL_BLOCK', False),
+            bot_identity.get('HTTP_KEEPALIVE', True)
+        )
+
+        # Metrics are installed before the rate governor so that every attempt of a request is timed
+
+        if self._metrics:
+            self._metrics.install(self._session)
+
+        self._governor = CiscoSparkRateGovernor(
+            bot_identity.get('RATE_LIMIT', CISCO_SPARK_RATE_LIMIT),
+            bot_identity.get('RATE_BURST', CISCO_SPARK_RATE_BURST),
+            bot_identity.get('RETRIES', CISCO_SPARK_RETRIES)
+        )
+        self._governor.install(self._session)
+
+        # With a snapshot from a previous run the bot identity, rooms and people are restored from disk rather than
+        # loaded from Spark. They are checked against Spark in the background once the bot has connected.
+
+        snapshot_file = bot_identity.get('SNAPSHOT_FILE', None)
+        self._snapshot = CiscoSparkSnapshot(
+            snapshot_file,
+            self._bot_token,
+            bot_identity.get('SNAPSHOT_MAX_AGE', CISCO_SPARK_SNAPSHOT_MAX_AGE)
+        ) if snapshot_file else None
+
+        snapshot = self._snapshot.load() if self._snapshot else None
+        self._snapshot_restored = snapshot is not None
+
+        if snapshot:
+            self.restore_snapshot(snapshot)
+        else:
+            self.bot_identifier = CiscoSparkPerson(self, self._session.people.me())
+
+        self._person_cache.set(self.bot_identifier.id, self.bot_identifier)
+        log.debug("Done! I'm connected as {} : {} ".format(self.bot_identifier, self.bot_identifier.emails))
+
+        if self._metrics:
+            self.register_gauges()
+
+        self._profiler = CiscoSparkProfiler(
+            self,
+            bot_identity.get('PROFILE_DIR', os.path.join(config.BOT_DATA_DIR, 'profiles')),
+            bot_identity.get('PROFILE_SAMPLE_INTERVAL', CISCO_SPARK_PROFILE_SAMPLE_INTERVAL)
+        )
+
+        self._commands = CiscoSparkCommands(self)
+        self._commands_injected = False
+
+        # serve_once waits on this event rather than polling, so a requested shutdown is acted on immediately
+
+        self._health_check_interval = bot_identity.get('HEALTH_CHECK_INTERVAL', CISCO_SPARK_HEALTH_CHECK_INTERVAL)
+        self._shutdown = threading.Event()
+        self._healthy = True
+
+    @property
+    def mode(self):
+        return 'CiscoSpark'
+
+    @property
+    def webhook_secret(self):
+        return self._webhook_secret
+
+    @property
+    def person_cache(self):
+        return self._person_cache
+
+    @property
+    def person_failures(self):
+        return self._person_failures
+
+    @property
+    def room_cache(self):
+        return self._room_cache
+
+    @property
+    def room_failures(self):
+        return self._room_failures
+
+    @property
+    def room_webhooks(self):
+        return self._room_webhooks
+
+    @property
+    def webhook_mode(self):
+        return self._webhook_mode
+
+    @property
+    def webhook_server(self):
+        return self._webhook_server
+
+    def is_event_allowed(self, event):
+        """
+        Check whether a webhook event is for a room this bot serves (see is_room_allowed)
+
+        :param event: The JSON payload of the webhook event
+        :return: Boolean
+        """
+        return self.is_room_allowed(self.get_event_room_id(event))
+
+    def is_room_allowed(self, room_id):
+        """
+        Check whether a room is one of the rooms in CHATROOM_PRESENCE. In room mode Spark only delivers events for the
+        rooms the webhooks are filtered on, in firehose mode events for all rooms the bot is a member of are delivered
+        and have to be filtered locally.
+
+        Sharded workers also drop the events for rooms owned by another worker.
+
+        :param room_id: The Spark ID of the room
+        :return: Boolean
+        """
+        if not self.owns_room(room_id):
+            return False
+        if self._webhook_mode == CISCO_SPARK_WEBHOOK_MODE_ROOM:
+            return True
+        return room_id in self._allowed_rooms
+
+    def owns_room(self, id):
+        """
+        Check whether a room belongs to this worker. Rooms are assigned to the SHARD_COUNT workers using a hash of
+        their id, so every worker agrees on the owner of a room without coordinating.
+
+        :param id: The Spark ID of the room
+        :return: Boolean
+        """
+        if self._shard_count == 1:
+            return True
+        digest = hashlib.sha1((id or '').encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % self._shard_count == self._shard_index
+
+    @staticmethod
+    def get_event_room_id(event):
+        """
+        Return the id of the room a webhook event relates to
+
+        :param event: The JSON payload of the webhook event
+        :return: The room id
+        """
+        data = event.get('data', {})
+        return data.get('id') if event.get('resource') == 'rooms' else data.get('roomId')
+
+    def process_webhook_event(self, event):
+        """
+        Process a webhook event received from Cisco Spark. New messages are dispatched to errbot and room or
+        membership changes refresh the room cache.
+
+        :param event: The JSON payload of the webhook event
+        """
+        if not self.is_event_allowed(event):
+            log.debug("Ignoring webhook event for room {}".format(self.get_event_room_id(event)))
+            return
+
+        resource = event.get('resource')
+
+        if resource == 'messages' and event.get('event') == 'created':
+            data = event.get('data', {})
+
+            if self._dedupe.seen(data.get('id')):
+                log.debug("Ignoring duplicate webhook event for message {}".format(data.get('id')))
+                return
+
+            start = time.perf_counter() if self._metrics else None
+            error = True
+
+            try:
+                self.process_message_event(data)
+                error = False
+            except Exception:
+                # Let a retry of this event be processed
+                self._dedupe.forget(data.get('id'))
+                raise
+            finally:
+                if start is not None:
+                    self._metrics.observe('dispatch', 'messages', time.perf_counter() - start, error,
+                                          data.get('roomId'))
+
+        elif resource == 'rooms':
+            self.room_changed(self.get_event_room_id(event))
+
+        elif resource == 'memberships':
+            self.membership_changed(event.get('event'), event.get('data', {}))
+
+    def process_message_event(self, data):
+        """
+        Load the message a messages/created webhook event refers to and dispatch it to errbot
 
-        if self._webhook_destination[len(self._webhook_destination) - 1] != '/':
-            self._webhook_destination += '/'
+        :param data: The data of the webhook event
+        """
+        # Ignore the messages the bot sent itself
+        if data.get('personId') == self.bot_identifier.id:
+            return
 
-        self._webhook_destination += CISCO_SPARK_WEBHOOK_URI
+        self.callback_message(self.hydrate_message_event(data))
 
-        # Initialize the CiscoSparkAPI session used to manage the Spark integration
+    def hydrate_message_event(self, data):
+        """
+        Build a CiscoSparkMessage from the data of a messages/created webhook event
 
-        log.debug("Fetching and building identifier for the bot itself.")
-        self._session = sparkapi.CiscoSparkAPI(self._bot_token)
-        self.bot_identifier = CiscoSparkPerson(self, self._session.people.me())
-        log.debug("Done! I'm connected as {} : {} ".format(self.bot_identifier, self.bot_identifier.emails))
+        The event only carries ids, so the message, the person who sent it and the room it was sent to are loaded
+        in parallel. The person and room are loaded through their caches.
 
-    @property
-    def mode(self):
-        return 'CiscoSpark'
+        :param data: The data of the webhook event
+        :return: CiscoSparkMessage
+        """
+        person = self._hydration_pool.submit(self.get_person_using_id, data['personId']) \
+            if data.get('personId') else None
+        room = self._hydration_pool.submit(self.get_room_using_id, data['roomId']) \
+            if data.get('roomId') else None
 
-    @property
-    def webhook_secret(self):
-        return self._webhook_secret
+        message = self.get_message_using_id(data['id'])
+
+        person = person.result() if person else self.get_person_using_id(message.personId)
+        room = room.result() if room else self.get_room_using_id(message.roomId)
+
+        return self.create_message(body=message.text,
+                                   frm=self.get_occupant_using_id(person=person, room=room),
+                                   to=room,
+                                   extras={'roomType': message.roomType, 'files': message.files or []})
 
-    def create_webhook(self, url=None, name=CISCO_SPARK_WEBHOOK_ID, resource='messages', event='created', filter=None,
-                       secret=None):
+    def create_webhook(self, url=None, name=None, resource='messages', event='created', filter=None, secret=None):
         """
         Create a webhook that the bot can consume
         :param url: The URL the webhook is to publish towards (by default the bots webhook will be used)
-        :param name: The name that will be given to the Webhook
+        :param name: The name that will be given to the Webhook (by default the name of the bot's webhooks)
         :param resource: The type of resource that we want Cisco Spark to monitor
         :param event: The type of event that we want Cisco Spark to monitor
         :param filter: Any filters that will limit to which events Cisco Spark will listen (e.g. roomId)
@@ -378,6 +3372,9 @@ class CiscoSparkBackend(ErrBot):
         if not url:
             url = self._webhook_destination
 
+        if not name:
+            name = self._webhook_name
+
         if not secret:
             secret = self.webhook_secret
 
@@ -400,19 +3397,201 @@ class CiscoSparkBackend(ErrBot):
 
     def delete_webhooks(self):
         """
-        Delete all webhooks for the bot that have the webhook name CISCO_SPARK_WEBHOOK_ID
+        Delete all webhooks for the bot that have the webhook name of this bot (or shard)
         """
         log.debug("Deleting ALL webhooks attached to rooms")
 
+        if self._webhook_mode == CISCO_SPARK_WEBHOOK_MODE_FIREHOSE:
+            # Every room shares the firehose webhooks so there is no need to search for them
+            hooks = list(self._room_webhooks.values()) + list(self._event_webhooks.values())
+            for hook in {hook.id: hook for hook in hooks}.values():
+                self.delete_webhook(hook)
+            self._room_webhooks.clear()
+            self._event_webhooks.clear()
+            log.debug("Done! ALL webhooks deleted")
+            return
+
         for hook in self.session.webhooks.list():
-            if hook.name == CISCO_SPARK_WEBHOOK_ID:
-                filer, filter_id = hook.filter.split("=")
-                if filer == 'roomId':
-                    if filter_id in self._bot_rooms:
-                        self.delete_webhook(hook)
+            if hook.name == self._webhook_name:
+                room_id = self.get_webhook_room_id(hook)
+                if room_id is None or room_id in self._bot_rooms:
+                    self.delete_webhook(hook)
 
+        self._room_webhooks.clear()
+        self._event_webhooks.clear()
         log.debug("Done! ALL webhooks deleted")
 
+    @staticmethod
+    def get_webhook_room_id(webhook):
+        """
+        Return the room id a webhook is filtered on
+
+        :param webhook: A Cisco Spark Webhook
+        :return: The room id or None if the webhook is not filtered by room
+        """
+        filer, _, filter_id = (webhook.filter or '').partition('=')
+        return filter_id if filer == 'roomId' else None
+
+    def is_webhook_current(self, webhook):
+        """
+        Check whether an existing webhook delivers new messages, membership changes or room changes to this bot with
+        the configured secret
+
+        :param webhook: A Cisco Spark Webhook
+        :return: Boolean
+        """
+        return (webhook.targetUrl == self._webhook_destination and
+                (webhook.resource, webhook.event) in CISCO_SPARK_WEBHOOK_EVENTS and
+                webhook.status in (None, 'active') and
+                webhook.secret in (None, self.webhook_secret))
+
+    def get_event_webhook_keys(self, room_id=None):
+        """
+        Return the memberships and rooms webhooks that keep the cached rooms current. In room mode the memberships
+        webhooks are filtered on each room while in firehose mode they are unfiltered. Spark can not filter rooms
+        webhooks by room, so a single unfiltered rooms webhook is shared by every room.
+
+        :param room_id: The Spark ID of a room, or None for the unfiltered webhooks
+        :return: A list of (resource, event, room id) tuples
+        """
+        if room_id is not None:
+            return [('memberships', event, room_id) for event in CISCO_SPARK_MEMBERSHIP_EVENTS]
+
+        keys = [('rooms', 'updated', None)]
+        if self._webhook_mode == CISCO_SPARK_WEBHOOK_MODE_FIREHOSE:
+            keys += [('memberships', event, None) for event in CISCO_SPARK_MEMBERSHIP_EVENTS]
+        return keys
+
+    def create_event_webhooks(self, room_id=None):
+        """
+        Create the memberships and rooms webhooks of a room (or the unfiltered ones) that are not yet registered
+
+        :param room_id: The Spark ID of a room, or None for the unfiltered webhooks
+        """
+        for key in self.get_event_webhook_keys(room_id):
+            if key not in self._event_webhooks:
+                resource, event, room_id = key
+                self._event_webhooks[key] = self.create_webhook(
+                    resource=resource, event=event, filter="roomId={}".format(room_id) if room_id else None)
+
+    def delete_event_webhooks(self, room_id):
+        """
+        Delete the memberships webhooks of a room
+
+        :param room_id: The Spark ID of the room
+        """
+        for key in self.get_event_webhook_keys(room_id):
+            hook = self._event_webhooks.pop(key, None)
+            if hook:
+                self.delete_webhook(hook)
+
+    def _keep_webhooks(self, hooks, wanted, messages):
+        """
+        Sort the existing webhooks of this bot into those still wanted and the stale ones to delete
+
+        :param hooks: The webhooks listed from Spark
+        :param wanted: The (resource, event, room id) keys of the memberships and rooms webhooks wanted
+        :param messages: A function of a room id returning whether a messages webhook filtered on it is wanted
+        :return: A list of the stale webhooks
+        """
+        stale = []
+
+        for hook in hooks:
+            if hook.name != self._webhook_name or hook.targetUrl != self._webhook_destination:
+                continue
+
+            room_id = self.get_webhook_room_id(hook)
+            key = (hook.resource, hook.event, room_id)
+
+            if not self.is_webhook_current(hook):
+                stale.append(hook)
+            elif hook.resource == 'messages' and messages(room_id) and room_id not in self._room_webhooks:
+                self._room_webhooks[room_id] = hook
+            elif key in wanted and key not in self._event_webhooks:
+                self._event_webhooks[key] = hook
+            else:
+                stale.append(hook)
+
+        return stale
+
+    def join_rooms(self):
+        """
+        Join every room in CHATROOM_PRESENCE and reconcile the existing webhooks against them
+
+        The existing webhooks are listed once. Webhooks that are still current for a configured room are kept, any
+        other webhooks this bot created for its destination are deleted, and the rooms without a webhook are joined
+        (which creates their webhooks). Deletes, joins and the creation of any other missing webhooks run concurrently
+        using a pool of STARTUP_WORKERS threads.
+
+        In firehose mode a single set of unfiltered webhooks is kept or created instead and no rooms are joined.
+        """
+        if self._webhook_mode == CISCO_SPARK_WEBHOOK_MODE_FIREHOSE:
+            self.reconcile_firehose_webhook()
+            return
+
+        log.debug("Reconciling webhooks for {} rooms".format(len(self._bot_rooms)))
+
+        self._room_webhooks.clear()
+        self._event_webhooks.clear()
+
+        wanted = set(self.get_event_webhook_keys())
+        for room_id in self._bot_rooms:
+            wanted.update(self.get_event_webhook_keys(room_id))
+
+        stale = self._keep_webhooks(self.session.webhooks.list(), wanted, lambda room_id: room_id in self._bot_rooms)
+
+        rooms = [self._room_cache.get(room_id) or self.create_room_using_id(room_id)
+                 for room_id in self._bot_rooms if room_id not in self._room_webhooks]
+
+        log.debug("Keeping {} webhooks, deleting {} and joining {} rooms".format(
+            len(self._room_webhooks) + len(self._event_webhooks), len(stale), len(rooms)))
+
+        # The rooms being joined create their own memberships webhooks
+        self._run_concurrently([partial(self.delete_webhook, hook) for hook in stale] +
+                               [room.join for room in rooms] +
+                               [partial(self.create_event_webhooks, room_id) for room_id in list(self._room_webhooks)] +
+                               [self.create_event_webhooks])
+
+        log.debug("Done! Webhooks reconciled")
+
+    def reconcile_firehose_webhook(self):
+        """
+        Make sure exactly one unfiltered webhook delivers new messages to this bot and share it between all the rooms
+        in CHATROOM_PRESENCE, along with one unfiltered webhook for each of the memberships and rooms events. The bot
+        is expected to already be a member of the rooms.
+        """
+        log.debug("Reconciling the firehose webhook")
+
+        self._room_webhooks.clear()
+        self._event_webhooks.clear()
+
+        stale = self._keep_webhooks(self.session.webhooks.list(), set(self.get_event_webhook_keys()),
+                                    lambda room_id: room_id is None)
+
+        self._run_concurrently([partial(self.delete_webhook, hook) for hook in stale] + [self.create_event_webhooks])
+
+        firehose = self._room_webhooks.get(None) or self.create_webhook()
+
+        self._room_webhooks.clear()
+        for room_id in self._bot_rooms:
+            self._room_webhooks[room_id] = firehose
+
+        log.debug("Done! Firehose webhook {} serving {} rooms".format(firehose.id, len(self._room_webhooks)))
+
+    def _run_concurrently(self, jobs):
+        """
+        Run jobs using a pool of STARTUP_WORKERS threads and log (rather than raise) any failures
+
+        :param jobs: A list of callables
+        """
+        if not jobs:
+            return
+
+        with ThreadPoolExecutor(max_workers=self._startup_workers) as pool:
+            for future in as_completed([pool.submit(job) for job in jobs]):
+                if future.exception():
+                    log.error("Failed to reconcile webhook: {}".format(future.exception()))
+
     # The following are convenience methods to make it easier to create objects from the err-cisco-spark-webhook plugin
     def get_person_using_email(self, email):
         """
@@ -421,7 +3600,14 @@ class CiscoSparkBackend(ErrBot):
         :param email: The email address to use for the search
         :return: CiscoSparkPerson
         """
-        return CiscoSparkPerson.find_using_email(self._session, email)
+        person = self._person_cache.get_using_email(email)
+        if person is None:
+            person = self._directory.get_using_email(email)
+        if person is None:
+            person = CiscoSparkPerson.find_using_email(self, email)
+            if person.id:
+                self._person_cache.set(person.id, person)
+        return person
 
     def get_person_using_id(self, id):
         """
@@ -430,11 +3616,28 @@ class CiscoSparkBackend(ErrBot):
         :param id: The spark id to use for the search
         :return: CiscoSparkPerson
         """
-        return CiscoSparkPerson.get_using_id(self._session, id)
+        person = self._person_cache.get(id)
+        if person is None:
+            person = self._single_flight.do(('person', id), self._load_person, id)
+        return person
+
+    def _load_person(self, id):
+        person = CiscoSparkPerson.get_using_id(self, id)
+        self._person_cache.set(id, person)
+        return person
+
+    def invalidate_person(self, id=None):
+        """
+        Remove a person from the person cache so the next lookup is loaded from Spark
+
+        :param id: The spark id of the person. If no id is provided the entire cache is cleared
+        """
+        self._person_cache.invalidate(id)
 
     def create_person_using_id(self, id):
         """
-        Create a new person and sets the ID. This method DOES NOT load the person details from Spark
+        Create a new person and sets the ID. This method DOES NOT load the person details from Spark, they are loaded
+        the first time they are accessed
 
         :param id: The spark id of the person
         :return: CiscoSparkPerson
@@ -450,11 +3653,154 @@ class CiscoSparkBackend(ErrBot):
         :param id: The Spark id of the room
         :return: CiscoSparkRoom
         """
-        return CiscoSparkRoom.get_using_id(self, id)
+        room = self._room_cache.get(id)
+        if room is None:
+            room = self._single_flight.do(('room', id), self._load_room, id)
+        return room
+
+    def _load_room(self, id):
+        room = CiscoSparkRoom.get_using_id(self, id)
+        self._room_cache.set(id, room)
+        return room
+
+    def invalidate_room(self, id=None):
+        """
+        Remove a room from the room cache so the next lookup is loaded from Spark
+
+        :param id: The Spark id of the room. If no id is provided the entire cache is cleared
+        """
+        self._room_cache.invalidate(id)
+
+    def room_changed(self, id):
+        """
+        Refresh the cached details of a room after its title has changed. This is called when a rooms/updated webhook
+        event is received for the room. Rooms that are neither cached nor in the directory are left alone as they will
+        be loaded in full when they are next needed.
+
+        :param id: The Spark id of the room
+        :return: CiscoSparkRoom or None if the room is not cached
+        """
+        room = self._room_cache.get(id) or self._directory.get_room(id)
+        if room is None:
+            return None
+
+        log.debug("Refreshing cached details for room {}".format(id))
+
+        # Reload the existing room so its occupants (which reference the room) are kept
+        room.load()
+        self._room_cache.set(id, room)
+        return room
+
+    def membership_changed(self, event, data):
+        """
+        Apply a memberships webhook event to the occupants of the cached room. Rooms that are not cached are left
+        alone as their occupants will be loaded in full when they are next needed.
+
+        :param event: The webhook event type (created, updated or deleted)
+        :param data: The membership data of the webhook event
+        """
+        room = self._room_cache.get(data.get('roomId')) or self._directory.get_room(data.get('roomId'))
+        if room is None:
+            return
+
+        if event == 'deleted':
+            room.membership_deleted(data)
+        else:
+            room.membership_created(data)
+
+        self._directory.membership_changed()
+
+    def prewarm_rooms(self):
+        """
+        Load the details of every room in CHATROOM_PRESENCE into the room cache using a single (paginated) list
+        request rather than one request per room
+
+        :return: The set of room ids cached or None if the rooms could not be listed
+        """
+        log.debug("Pre-warming the room cache for {} rooms".format(len(self._bot_rooms)))
+
+        cached = set()
+        try:
+            for spark_room in self.session.rooms.list():
+                if spark_room.id in self._bot_rooms:
+                    cached.add(spark_room.id)
+                    # Rooms that are already cached are updated in place so their occupants are kept
+                    room = self._room_cache.get(spark_room.id)
+                    if room is None:
+                        room = CiscoSparkRoom(self, spark_room)
+                    else:
+                        room._set_details(spark_room._json_data)
+                    self._room_cache.set(spark_room.id, room)
+        except Exception:
+            log.exception("Failed to pre-warm the room cache")
+            return None
+
+        log.debug("Done! {} rooms cached".format(len(self._room_cache)))
+        return cached
+
+    def restore_snapshot(self, snapshot):
+        """
+        Restore the bot identity, room cache and person cache from a snapshot
+
+        :param snapshot: The snapshot loaded by CiscoSparkSnapshot
+        """
+        self.bot_identifier = CiscoSparkPerson(self, snapshot['me'])
+
+        for room in snapshot.get('rooms', []):
+            self._room_cache.set(room['id'], CiscoSparkRoom(self, room))
+
+        for person in snapshot.get('people', []):
+            self._person_cache.set(person['id'], CiscoSparkPerson(self, person))
+
+        log.info("Restored {} rooms and {} people from the snapshot".format(len(self._room_cache),
+                                                                           len(self._person_cache)))
+
+    def validate_snapshot(self):
+        """
+        Check the details restored from the snapshot against Spark, replacing any that have changed. Rooms the bot
+        can no longer see are removed from the room cache.
+        """
+        log.debug("Validating the details restored from the snapshot")
+
+        try:
+            me = CiscoSparkPerson(self, self.session.people.me())
+            if me.id != self.bot_identifier.id:
+                log.warning("The bot identity has changed from {} to {}".format(self.bot_identifier, me))
+            self.bot_identifier = me
+            self._person_cache.set(me.id, me)
+        except Exception:
+            log.exception("Failed to validate the bot identity")
+
+        restored_rooms = [room.id for room in self._room_cache.values()]
+        cached = self.prewarm_rooms()
+        if cached is not None:
+            for id in restored_rooms:
+                if id not in cached:
+                    self._room_cache.invalidate(id)
+
+        for person in self._person_cache.values():
+            if person.id != self.bot_identifier.id:
+                try:
+                    self._single_flight.do(('person', person.id), self._load_person, person.id)
+                except Exception:
+                    log.exception("Failed to validate person {}".format(person.id))
+
+        log.debug("Done! The snapshot has been validated")
+
+    def save_snapshot(self):
+        """
+        Save the bot identity, room cache and person cache so the next start can skip loading them from Spark
+        """
+        self._snapshot.save(
+            self.bot_identifier.to_dict(),
+            [room.to_dict() for room in self._room_cache.values() if not room.is_stub],
+            [person.to_dict() for person in self._person_cache.values() if not person.is_stub]
+        )
 
     def create_room_using_id(self, id):
         """
-        Create a new room and sets the ID. This method DOES NOT load the room details from Spark
+        Create a new room and sets the ID. This method DOES NOT load the room details from Spark, they are loaded the
+        first time they are accessed
         :param id:
         :return:
         """
@@ -462,6 +3808,19 @@ class CiscoSparkBackend(ErrBot):
         room.id = id
         return room
 
+    def callback_message(self, msg):
+        """
+        Dispatch a received message to errbot, dropping messages from rooms this bot does not serve. Messages from
+        both the built-in webhook server and the err-webhook-cisco-spark plugin arrive here.
+
+        :param msg: CiscoSparkMessage
+        """
+        if isinstance(msg.to, CiscoSparkRoom) and not self.is_room_allowed(msg.to.id):
+            log.debug("Ignoring message for room {}".format(msg.to.id))
+            return
+
+        super().callback_message(msg)
+
     def create_message(self, body, frm, to, extras):
         """
         Creates a new message ready for sending
@@ -501,6 +3860,75 @@ class CiscoSparkBackend(ErrBot):
         """
         return self._session
 
+    def configure_http_pool(self, size, hosts, block, keepalive):
+        """
+        Replace the default HTTP connection pool of the session
+
+        :param size: The maximum number of connections kept open to each host
+        :param hosts: The number of hosts to keep connection pools for
+        :param block: Whether to wait for a free connection rather than open more than size connections to a host
+        :param keepalive: Whether to keep connections alive. When False every request uses a new connection.
+        """
+        log.debug("Sizing the HTTP connection pool to {} connections per host".format(size))
+
+        http = self._session._session._req_session
+        adapter = CiscoSparkHTTPAdapter(keepalive=keepalive, pool_connections=hosts, pool_maxsize=max(size, 1),
+                                        pool_block=block)
+        http.mount('https://', adapter)
+        http.mount('http://', adapter)
+
+        if not keepalive:
+            http.headers['Connection'] = 'close'
+
+    @property
+    def metrics(self):
+        """
+        The metrics recorded by the backend, or None when METRICS is disabled
+        :return: CiscoSparkMetrics
+        """
+        return self._metrics
+
+    @property
+    def profiler(self):
+        """
+        The profiler of the dispatch and send paths
+        :return: CiscoSparkProfiler
+        """
+        return self._profiler
+
+    def register_gauges(self):
+        """
+        Register the queue depths, cache statistics and rate limiting state of the backend as metrics gauges
+        """
+        if self._send_queue:
+            self._metrics.gauge('queue_depth', {'queue': 'send'}, lambda: self._send_queue.depth)
+        if self._coalescer:
+            self._metrics.gauge('coalesced_messages', {}, lambda: self._coalescer.coalesced)
+        if self._webhook_server:
+            self._metrics.gauge('queue_depth', {'queue': 'webhook'}, lambda: self._webhook_server.depth)
+        self._metrics.gauge('queue_depth', {'queue': 'storage'}, lambda: self._store.dirty)
+
+        for name, cache in (('person', self._person_cache), ('room', self._room_cache)):
+            self._metrics.gauge('cache_hits', {'cache': name}, partial(getattr, cache, 'hits'))
+            self._metrics.gauge('cache_misses', {'cache': name}, partial(getattr, cache, 'misses'))
+            self._metrics.gauge('cache_size', {'cache': name}, cache.__len__)
+        self._metrics.gauge('cache_hits', {'cache': 'markdown'}, lambda: self._markdown.cache_info.hits)
+        self._metrics.gauge('cache_misses', {'cache': 'markdown'}, lambda: self._markdown.cache_info.misses)
+
+        self._metrics.gauge('duplicate_events', {}, lambda: self._dedupe.duplicates)
+        self._metrics.gauge('healthy', {}, lambda: int(self._healthy))
+        self._metrics.gauge('rate_limit_rate', {}, lambda: self._governor.rate)
+        self._metrics.gauge('rate_limit_throttled', {}, lambda: self._governor.throttled)
+        self._metrics.gauge('rate_limit_retried', {}, lambda: self._governor.retried)
+
+    @property
+    def governor(self):
+        """
+        The rate governor pacing every request made through the session
+        :return: CiscoSparkRateGovernor
+        """
+        return self._governor
+
 
     def follow_room(self, room):
         """
@@ -514,21 +3942,27 @@ class CiscoSparkBackend(ErrBot):
 
     def rooms(self):
         """
-        Backend: Rooms yet to be implemented
+        Return the rooms the bot is a member of
 
-        :return:
+        :return: A list of CiscoSparkRoom
         """
-        log.debug("Backend: Rooms yet to be implemented")  # TODO
-        pass
+        return self._directory.rooms()
 
     def contacts(self):
         """
-        Backend: Contacts yet to be implemented
+        Return the people in the rooms the bot is a member of
 
-        :return:
+        :return: A list of CiscoSparkPerson
         """
-        log.debug("Backend: Contacts yet to be implemented")  # TODO
-        pass
+        return self._directory.people()
+
+    @property
+    def directory(self):
+        """
+        The directory of the rooms the bot is a member of and the people in them
+        :return: CiscoSparkDirectory
+        """
+        return self._directory
 
     def build_identifier(self, strrep):
         """
@@ -537,7 +3971,10 @@ class CiscoSparkBackend(ErrBot):
         :param strrep: The ID of the Cisco Spark person
         :return: CiscoSparkPerson
         """
-        return self.create_person_using_id(strrep)
+        person = self._person_cache.get(strrep)
+        if person is None:
+            person = self.create_person_using_id(strrep)
+        return person
 
     def query_room(self, room):
         """
@@ -546,7 +3983,7 @@ class CiscoSparkBackend(ErrBot):
         :param room: The Cisco Spark room ID
         :return: CiscoSparkRoom object
         """
-        return CiscoSparkRoom.get_using_id(self, room)
+        return self.get_room_using_id(room)
 
     def send_message(self, mess):
         """
@@ -554,11 +3991,157 @@ class CiscoSparkBackend(ErrBot):
 
         :param mess: A CiscoSparkMessage
         """
-        md = markdown(mess.body, extensions=['markdown.extensions.nl2br', 'markdown.extensions.fenced_code'])
-        if type(mess.to) == CiscoSparkPerson:
-            self.session.messages.create(toPersonId=mess.to.id, text=mess.body, markdown=md)
+        destination = self.get_destination(mess.to)
+
+        if self._coalescer:
+            self._coalescer.put(destination, mess.body)
+        else:
+            self.queue_message(destination, mess.body)
+
+    @staticmethod
+    def get_destination(identifier):
+        """
+        Return where a message to an identifier is sent
+
+        :param identifier: A CiscoSparkPerson, CiscoSparkRoom or CiscoSparkRoomOccupant (which is sent to the room)
+        :return: A tuple of the destination type (roomId or toPersonId) and the Spark ID
+        """
+        if type(identifier) == CiscoSparkPerson:
+            return 'toPersonId', identifier.id
+        if isinstance(identifier, CiscoSparkRoom):
+            return 'roomId', identifier.id
+        return 'roomId', identifier.room.id
+
+    def queue_message(self, destination, body):
+        """
+        Queue a message for delivery, or deliver it immediately when there are no send workers
+
+        :param destination: A tuple of the destination type (roomId or toPersonId) and the Spark ID
+        :param body: The message text
+        """
+        job = partial(self._deliver_message, body, **dict([destination]))
+
+        if self._send_queue:
+            self._send_queue.put(destination[1], job)
+        else:
+            job()
+
+    def _deliver_message(self, body, **destination):
+        # Bodies larger than a single Spark message are sent as consecutive messages. As they are sent by the one job
+        # the chunks can not be interleaved with other messages to the same destination.
+        for text, markdown in self._markdown.split(body, self.bot_config.MESSAGE_SIZE_LIMIT):
+            self.session.messages.create(text=text, markdown=markdown, **destination)
+
+    def send_stream_request(self, identifier, fsource, name=None, size=None, stream_type=None):
+        """
+        Send a file to a room or person. The file is streamed to Spark so it is never held in memory, and is queued
+        behind the messages already being sent to the same destination.
+
+        :param identifier: A CiscoSparkPerson, CiscoSparkRoom or CiscoSparkRoomOccupant
+        :param fsource: A file opened in binary mode (or any binary file-like object)
+        :param name: The file name shown in Spark
+        :param size: The size of the file in bytes, if fsource can not seek to find it
+        :param stream_type: The mime type of the file (guessed from the name by default)
+        :return: An errbot Stream whose status reports the progress of the upload
+        """
+        name = name or os.path.basename(getattr(fsource, 'name', '') or 'file')
+        stream_type = stream_type or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+        if size is None:
+            if not fsource.seekable():
+                raise ValueError("The size of {} must be provided as the file can not seek".format(name))
+            position = fsource.tell()
+            size = fsource.seek(0, io.SEEK_END) - position
+            fsource.seek(position)
+
+        if size > self._file_upload_limit:
+            raise ValueError("{} is {} bytes, larger than the upload limit of {} bytes".format(
+                name, size, self._file_upload_limit))
+
+        stream = Stream(identifier, fsource, name, size, stream_type)
+        destination = self.get_destination(identifier)
+        job = partial(self._upload_stream, stream, destination)
+
+        # Messages still waiting to be merged are sent first so the file follows them
+        if self._coalescer:
+            self._coalescer.flush(destination)
+
+        if self._send_queue:
+            self._send_queue.put(destination[1], job)
         else:
-            self.session.messages.create(roomId=mess.to.room.id, text=mess.body, markdown=md)
+            job()
+
+        return stream
+
+    def _upload_stream(self, stream, destination):
+        stream.accept()
+
+        try:
+            upload = CiscoSparkUpload(dict([destination]), stream.name, stream.raw, stream.size, stream.stream_type)
+            self.session._session.post('messages', data=upload, headers={'Content-type': upload.content_type},
+                                       hooks={'response': upload.sent})
+        except Exception:
+            stream.error()
+            raise
+
+        stream.success()
+        log.debug("Uploaded {} ({} bytes) to {}".format(stream.name, stream.size, destination[1]))
+
+    def download_file(self, url, destination):
+        """
+        Download a file attached to a message (see the files extra of a CiscoSparkMessage). The file is written a
+        chunk at a time so it is never held in memory, and downloads larger than FILE_DOWNLOAD_LIMIT are abandoned.
+
+        :param url: The URL of the file
+        :param destination: A directory (the file keeps the name given by Spark), a file path or a binary file object
+        :return: The path of the file written, or the file object
+        """
+        response = self.session._session.request('GET', url, 200, stream=True)
+
+        try:
+            length = int(response.headers.get('Content-Length') or 0)
+            if length > self._file_download_limit:
+                raise ValueError("{} is {} bytes, larger than the download limit of {} bytes".format(
+                    url, length, self._file_download_limit))
+
+            if hasattr(destination, 'write'):
+                self._write_download(response, destination, url)
+                return destination
+
+            if os.path.isdir(destination):
+                name = re.search(r'filename="?([^";]+)', response.headers.get('Content-Disposition', ''))
+                destination = os.path.join(destination, os.path.basename(name.group(1) if name else 'file'))
+
+            try:
+                with open(destination, 'wb') as file:
+                    self._write_download(response, file, url)
+            except Exception:
+                # Do not leave a partial file behind
+                os.remove(destination)
+                raise
+
+            return destination
+        finally:
+            response.close()
+
+    def _write_download(self, response, file, url):
+        written = 0
+        for chunk in response.iter_content(chunk_size=CISCO_SPARK_FILE_CHUNK_SIZE):
+            written += len(chunk)
+            if written > self._file_download_limit:
+                raise ValueError("{} is larger than the download limit of {} bytes".format(
+                    url, self._file_download_limit))
+            file.write(chunk)
+        log.debug("Downloaded {} ({} bytes)".format(url, written))
+
+    def split_and_send_message(self, mess):
+        """
+        Send a message without errbot splitting it first, as send_message splits large messages at markdown
+        boundaries rather than every MESSAGE_SIZE_LIMIT characters
+
+        :param mess: A CiscoSparkMessage
+        """
+        self.send_message(mess)
 
     def build_reply(self, mess, text=None, private=False, threaded=False):
         """
@@ -575,30 +4158,161 @@ class CiscoSparkBackend(ErrBot):
         response.to = mess.frm
         return response
 
+    def connect_callback(self):
+        """
+        Connection has been established, join the rooms in CHATROOM_PRESENCE and warm the room cache before errbot
+        queries them
+        """
+        if self._webhook_server:
+            self._webhook_server.start()
+
+        if self._metrics_server:
+            self._metrics_server.start()
+
+        if not self._commands_injected:
+            self.inject_commands_from(self._commands)
+            self._commands_injected = True
+
+        # The rooms are loaded before they are joined so that joining does not load each of them on its own
+        if not self._snapshot_restored:
+            self.prewarm_rooms()
+
+        self.join_rooms()
+
+        if self._snapshot_restored:
+            threading.Thread(target=self.validate_snapshot, name='CiscoSparkSnapshot', daemon=True).start()
+
+        self._directory.start()
+
+        super().connect_callback()
+
     def disconnect_callback(self):
         """
-        Disconnection has been requested, lets make sure we clean up our per-room webhooks
+        Disconnection has been requested, lets make sure we deliver any queued messages and clean up our per-room
+        webhooks
         """
+        # Stop receiving first, the events already accepted are processed and their replies queued before draining
+        if self._webhook_server:
+            self._webhook_server.stop()
+
+        if self._coalescer:
+            self._coalescer.flush()
+
+        if self._send_queue:
+            self._send_queue.drain(self._send_drain_timeout)
+
+        self._profiler.stop()
+
+        if self._snapshot:
+            self.save_snapshot()
+
         self.delete_webhooks()
+
+        if self._metrics_server:
+            self._metrics_server.stop()
+
+        self._directory.stop()
+        self._store.stop()
         super().disconnect_callback()
 
+    @property
+    def healthy(self):
+        """
+        Whether the last health check found the token accepted and the webhooks of the bot active
+        :return: Boolean
+        """
+        return self._healthy
+
+    def request_shutdown(self):
+        """
+        Ask serve_once to disconnect from Spark and return. Safe to call from any thread or a signal handler.
+        """
+        self._shutdown.set()
+
+    def check_health(self):
+        """
+        Check that Spark still accepts the token and that the webhooks of the bot are still registered and active
+
+        Webhooks can be deleted by another application using the token, or disabled by Spark after their deliveries
+        fail. When a webhook is missing or disabled, a room has no webhook, or Spark was unreachable at the last check,
+        the webhooks are reconciled again (see join_rooms).
+
+        :return: Boolean, whether the bot is healthy
+        """
+        try:
+            self.session.people.me()
+
+            hooks = {hook.id: hook for hook in self.session.webhooks.list()
+                     if hook.name == self._webhook_name and hook.targetUrl == self._webhook_destination}
+
+            registered = list(self._room_webhooks.values()) + list(self._event_webhooks.values())
+            lost = {hook.id for hook in registered
+                    if hook.id not in hooks or not self.is_webhook_current(hooks[hook.id])}
+            unjoined = [room_id for room_id in self._bot_rooms if room_id not in self._room_webhooks]
+
+            wanted = self.get_event_webhook_keys()
+            if self._webhook_mode == CISCO_SPARK_WEBHOOK_MODE_ROOM:
+                wanted += [key for room_id in self._room_webhooks for key in self.get_event_webhook_keys(room_id)]
+            lost.update(key for key in wanted if key not in self._event_webhooks)
+
+            if lost or unjoined or not self._healthy:
+                log.warning("Reconciling webhooks: {} missing or disabled, {} rooms without a webhook".format(
+                    len(lost), len(unjoined)))
+                self.join_rooms()
+
+        except sparkapi.exceptions.SparkApiError as error:
+            response = error.response
+            if response.status_code in (401, 403):
+                log.error("Spark has rejected the TOKEN of the bot ({} {})".format(response.status_code,
+                                                                                  response.reason))
+            else:
+                log.error("Health check failed ({} {})".format(response.status_code, response.reason))
+            self._healthy = False
+
+        except requests.exceptions.RequestException as error:
+            log.error("Health check failed, Spark can not be reached: {}".format(error))
+            self._healthy = False
+
+        else:
+            self._healthy = True
+
+        return self._healthy
+
     def serve_once(self):
         """
         Signal that we are connected to the Spark Service and hang around waiting for disconnection request
 
         As Cisco Spark uses Webhooks for integration there is no need to kick-off threads to listen to channels/rooms.
-        We just hand around relying on the err-backend-cisco-spark plugin to feed the backend.
+        We just hang around relying on either the built-in webhook server (WEBHOOK_LISTEN_PORT) or the
+        err-webhook-cisco-spark plugin to feed the backend, checking the health of the integration every
+        HEALTH_CHECK_INTERVAL seconds. A SIGTERM or request_shutdown disconnects straight away.
 
         """
-        self.connect_callback()
+        self._shutdown.clear()
+        terminate = self._handle_sigterm()
+
         try:
-            while True:
-                time.sleep(2)
+            # Connecting inside the try releases the listening ports when it fails part way, so that the reconnect
+            # errbot schedules can bind them again
+            self.connect_callback()
+            self.reset_reconnection_count()
+            while not self._shutdown.wait(self._health_check_interval or None):
+                self.check_health()
+            log.info("Shutdown requested, shutting down..")
+            return True
         except KeyboardInterrupt:
             log.info("Interrupt received, shutting down..")
             return True
         finally:
             self.disconnect_callback()
+            if terminate is not None:
+                signal.signal(signal.SIGTERM, terminate)
+
+    def _handle_sigterm(self):
+        # Signal handlers can only be installed from the main thread
+        if threading.current_thread() is not threading.main_thread():
+            return None
+        return signal.signal(signal.SIGTERM, lambda signum, frame: self.request_shutdown())
 
     def change_presence(self, status, message):
         """
@@ -631,9 +4345,7 @@ class CiscoSparkBackend(ErrBot):
         :param key: The dictionary key
         :param value:  The value to be assigned to the key
         """
-        values = self.recall(id)
-        values[key] = value
-        self[id] = values
+        self._store.set_key(id, key, value)
 
     def forget(self, id, key):
         """
@@ -643,10 +4355,7 @@ class CiscoSparkBackend(ErrBot):
         :param key: The dictionary key
         :return: The popped value or None if the key was not found
         """
-        values = self.recall(id)
-        value = values.pop(key, None)
-        self[id] = values
-        return value
+        return self._store.pop_key(id, key)
 
     def recall(self, id):
         """
@@ -655,8 +4364,7 @@ class CiscoSparkBackend(ErrBot):
         :param id: Spark ID of room or person
         :return: A dictionary. If no dictionary was found an empty dictionary will be returned.
         """
-        values = self.get(id)
-        return values if values else {}
+        return self._store.get(id)
 
     def recall_key(self, id, key):
         """
@@ -666,4 +4374,4 @@ class CiscoSparkBackend(ErrBot):
         :param key: The dictionary key
         :return: Either the value of the key or None if the key is not found
         """
-        return self.recall(id).get(key)
+        return self._store.get_key(id, key)
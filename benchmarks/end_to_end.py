@@ -0,0 +1,156 @@
+"""
+End to end benchmark of the backend against the fake Spark API in fake_spark.py
+
+Signed webhook events are posted to the backend's built-in webhook server. The backend hydrates each one into a
+CiscoSparkMessage and a stand-in plugin replies to it through send_message. The latency of a message is measured from
+the moment its webhook is posted until the reply reaches the fake API.
+
+Each run is made in a fresh process so the reported peak memory (RSS) belongs to that run alone.
+
+Usage: python benchmarks/end_to_end.py [--sizes 1000,10000,100000] [--latency 0.005] [--rate-limit 0.001]
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from CiscoSpark import CiscoSparkBackend  # noqa
+from fake_spark import FakeSparkAPI  # noqa
+
+SECRET = 'benchmark'
+
+
+class EchoBackend(CiscoSparkBackend):
+    """
+    The real backend with errbot's plugin dispatch replaced by a plugin that replies to every message
+    """
+    def callback_message(self, msg):
+        self.send_message(self.build_reply(msg, 'echo {}'.format(msg.body)))
+
+
+class Config(object):
+    BOT_PREFIX = '!'
+    BOT_ASYNC = False
+    BOT_ALT_PREFIXES = ()
+    BOT_ALT_PREFIX_CASEINSENSITIVE = False
+    MESSAGE_SIZE_LIMIT = 7439
+    BOT_DATA_DIR = tempfile.gettempdir()
+
+    def __init__(self, api, rooms, identity):
+        self.CHATROOM_PRESENCE = tuple('R-{}'.format(number) for number in range(rooms))
+        self.BOT_IDENTITY = dict({
+            'TOKEN': 'benchmark',
+            'WEBHOOK_DESTINATION': 'http://127.0.0.1/',
+            'WEBHOOK_SECRET': SECRET,
+            'WEBHOOK_LISTEN_HOST': '127.0.0.1',
+            'WEBHOOK_LISTEN_PORT': 0,
+            'API_BASE_URL': api.base_url,
+        }, **identity)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(size, args):
+    api = FakeSparkAPI(rooms=args.rooms, latency=args.latency, rate_limit_probability=args.rate_limit).start()
+    backend = EchoBackend(Config(api, args.rooms, json.loads(args.identity)))
+
+    posted = {}
+    replied = {}
+    finished = threading.Event()
+
+    def on_message_created(message):
+        replied[message['text'].rpartition(' ')[2]] = time.perf_counter()
+        if len(replied) >= size:
+            finished.set()
+
+    api.on_message_created = on_message_created
+
+    backend.webhook_server.start()
+    backend.join_rooms()
+    backend.prewarm_rooms()
+
+    url = 'http://127.0.0.1:{}/errbot/spark'.format(backend.webhook_server.port)
+
+    def client(numbers):
+        session = requests.Session()
+        for number in numbers:
+            id = 'MSG-{}'.format(number)
+            body = json.dumps({'resource': 'messages', 'event': 'created', 'data': {
+                'id': id, 'roomId': 'R-{}'.format(number % args.rooms), 'personId': 'P-{}'.format(number % 100)
+            }}).encode('utf-8')
+            signature = hmac.new(SECRET.encode('utf-8'), body, hashlib.sha1).hexdigest()
+
+            posted[id] = time.perf_counter()
+            while session.post(url, data=body, headers={'X-Spark-Signature': signature}).status_code == 503:
+                time.sleep(0.01)
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(range(offset, size, args.clients),))
+               for offset in range(args.clients)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+    completed = finished.wait(args.timeout)
+    elapsed = max(replied.values()) - start if replied else float('nan')
+    latencies = sorted(replied[id] - posted[id] for id in replied)
+
+    backend.webhook_server.stop()
+    backend.delete_webhooks()
+    api.stop()
+
+    return {
+        'size': size,
+        'completed': len(replied) if completed else '{} (timed out)'.format(len(replied)),
+        'throughput': len(replied) / elapsed,
+        'p50': percentile(latencies, 0.5) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'requests': api.requests,
+        'rate_limited': api.rate_limited,
+        'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Comma separated numbers of messages')
+    parser.add_argument('--rooms', type=int, default=10, help='Number of rooms the messages are spread across')
+    parser.add_argument('--clients', type=int, default=8, help='Number of threads posting webhook events')
+    parser.add_argument('--latency', type=float, default=0.005, help='Seconds added to every fake API request')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='Fraction of fake API requests answered with 429')
+    parser.add_argument('--identity', default='{"RATE_LIMIT": 1000, "RATE_BURST": 100}',
+                        help='JSON of extra BOT_IDENTITY settings (e.g. worker counts or rate limits)')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds to wait for the replies of a run')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run(args.single, args)))
+        return
+
+    print('{:>8} {:>10} {:>12} {:>10} {:>10} {:>10} {:>8} {:>10}'.format(
+        'messages', 'completed', 'msg/s', 'p50 (ms)', 'p99 (ms)', 'requests', '429s', 'RSS (MB)'))
+
+    for size in args.sizes.split(','):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--single', size] + sys.argv[1:])
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        print('{size:>8} {completed:>10} {throughput:>12.1f} {p50:>10.1f} {p99:>10.1f} {requests:>10} '
+              '{rate_limited:>8} {rss:>10.1f}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+An in-process stand-in for the Cisco Spark REST API used by the benchmarks
+
+Supports the messages, people, rooms, memberships and webhooks resources used by the backend. Messages, people and
+rooms are generated on demand from their ids so no data has to be loaded up front:
+
+    message MSG-<n> is sent by person P-<n % people> to room R-<n % rooms>
+
+Every request can be delayed by a fixed latency and a fraction of requests can be rejected with a 429.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeSparkAPI(object):
+    """
+    A fake Spark REST API served from a background thread
+    """
+    def __init__(self, rooms=10, people=100, members=50, latency=0.0, rate_limit_probability=0.0, retry_after=1):
+
+        self.rooms = rooms
+        self.people = people
+        self.members = members
+        self.latency = latency
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after = retry_after
+        self.requests = 0
+        self.connections = 0
+        self.rate_limited = 0
+        self.webhooks = {}
+        self.on_message_created = None
+        self._lock = threading.Lock()
+        self._ids = 0
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Otherwise every keep-alive response stalls on a delayed ACK between its headers and body
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with api._lock:
+                    api.connections += 1
+
+            def do_GET(self):
+                api.handle(self, 'GET')
+
+            def do_POST(self):
+                api.handle(self, 'POST')
+
+            def do_PUT(self):
+                api.handle(self, 'PUT')
+
+            def do_DELETE(self):
+                api.handle(self, 'DELETE')
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}/v1/'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # Generated resources
+
+    def person(self, id):
+        number = id.rpartition('-')[2]
+        return {'id': id, 'emails': ['person{}@example.com'.format(number)], 'displayName': 'Person {}'.format(number)}
+
+    def room(self, id):
+        return {'id': id, 'title': 'Room {}'.format(id.rpartition('-')[2]), 'type': 'group'}
+
+    def message(self, id):
+        number = int(id.rpartition('-')[2])
+        return {'id': id, 'roomId': 'R-{}'.format(number % self.rooms), 'roomType': 'group',
+                'personId': 'P-{}'.format(number % self.people), 'text': 'message {}'.format(id)}
+
+    def membership(self, room_id, number):
+        person = self.person('P-{}'.format(number))
+        return {'id': 'MS-{}-{}'.format(room_id, number), 'roomId': room_id, 'personId': person['id'],
+                'personEmail': person['emails'][0], 'personDisplayName': person['displayName']}
+
+    # Request handling
+
+    def handle(self, request, method):
+        with self._lock:
+            self.requests += 1
+            rate_limited = random.random() < self.rate_limit_probability
+            if rate_limited:
+                self.rate_limited += 1
+
+        length = int(request.headers.get('Content-Length') or 0)
+        body = json.loads(request.rfile.read(length).decode('utf-8')) if length else {}
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if rate_limited:
+            return self.respond(request, 429, {'message': 'Too Many Requests'}, {'Retry-After': str(self.retry_after)})
+
+        url = urlparse(request.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parts = url.path.strip('/').split('/')[1:]
+        resource, id = parts[0], parts[1] if len(parts) > 1 else None
+
+        try:
+            status, payload = getattr(self, '{}_{}'.format(method.lower(), resource))(id, query, body)
+        except AttributeError:
+            status, payload = 404, {'message': 'Not Found'}
+
+        self.respond(request, status, payload)
+
+    @staticmethod
+    def respond(request, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        request.send_response(status)
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def next_id(self, prefix):
+        with self._lock:
+            self._ids += 1
+            return '{}-{}'.format(prefix, self._ids)
+
+    def get_people(self, id, query, body):
+        if id == 'me':
+            return 200, {'id': 'BOT', 'emails': ['bot@example.com'], 'displayName': 'Bot'}
+        if id:
+            return 200, self.person(id)
+        if 'email' in query:
+            return 200, {'items': [self.person('P-{}'.format(query['email'][6:].partition('@')[0]))]}
+        return 200, {'items': [self.person('P-{}'.format(number)) for number in range(self.people)]}
+
+    def get_rooms(self, id, query, body):
+        if id:
+            return 200, self.room(id)
+        return 200, {'items': [self.room('R-{}'.format(number)) for number in range(self.rooms)]}
+
+    def get_memberships(self, id, query, body):
+        return 200, {'items': [self.membership(query.get('roomId'), number) for number in range(self.members)]}
+
+    def post_memberships(self, id, query, body):
+        return 200, {'id': self.next_id('MS'), 'roomId': body.get('roomId'), 'personId': body.get('personId')}
+
+    def get_messages(self, id, query, body):
+        return 200, self.message(id)
+
+    def post_messages(self, id, query, body):
+        message = dict(body, id=self.next_id('SENT'))
+        if self.on_message_created:
+            self.on_message_created(message)
+        return 200, message
+
+    def get_webhooks(self, id, query, body):
+        return 200, {'items': list(self.webhooks.values())}
+
+    def post_webhooks(self, id, query, body):
+        webhook = dict(body, id=self.next_id('WH'), status='active')
+        self.webhooks[webhook['id']] = webhook
+        return 200, webhook
+
+    def delete_webhooks(self, id, query, body):
+        self.webhooks.pop(id, None)
+        return 204, None
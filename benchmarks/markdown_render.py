@@ -0,0 +1,52 @@
+"""
+Micro-benchmark comparing the per-message cost of rendering markdown in send_message
+
+Before: a new markdown pipeline is built for every message
+After: CiscoSparkMarkdown (plain text fast path, per-thread renderer and memoized output)
+
+Usage: python benchmarks/markdown_render.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+from markdown import markdown
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from CiscoSpark import CiscoSparkMarkdown, CISCO_SPARK_MARKDOWN_CACHE_SIZE, CISCO_SPARK_MARKDOWN_EXTENSIONS  # noqa
+
+BODIES = {
+    'plain': 'The deployment of build 1234 finished successfully',
+    'help': '\n'.join(['**Available commands**'] + ['* `!command{}` - does thing number {}'.format(i, i)
+                                                     for i in range(20)]),
+    'code': 'Last log lines:\n```\n' + '\n'.join('2017-01-01 00:00:{:02} INFO line {}'.format(i, i)
+                                                 for i in range(40)) + '\n```',
+}
+
+
+def before(body):
+    return markdown(body, extensions=CISCO_SPARK_MARKDOWN_EXTENSIONS)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    renderer = CiscoSparkMarkdown(CISCO_SPARK_MARKDOWN_CACHE_SIZE)
+
+    print('{:<8} {:>14} {:>14} {:>10}'.format('body', 'before (us)', 'after (us)', 'speedup'))
+
+    for name, body in BODIES.items():
+        assert renderer.render(body) == before(body)
+        old = timeit.timeit(lambda: before(body), number=iterations) / iterations * 1e6
+        new = timeit.timeit(lambda: renderer.render(body), number=iterations) / iterations * 1e6
+        print('{:<8} {:>14.1f} {:>14.1f} {:>9.0f}x'.format(name, old, new, old / new))
+
+    # Unique bodies miss the memo cache and pay the full rendering cost
+    unique = ['{} {}'.format(BODIES['help'], i) for i in range(iterations)]
+    old = timeit.timeit(lambda: [before(body) for body in unique], number=1) / iterations * 1e6
+    new = timeit.timeit(lambda: [renderer.render(body) for body in unique], number=1) / iterations * 1e6
+    print('{:<8} {:>14.1f} {:>14.1f} {:>9.1f}x'.format('unique', old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark of the memory held by the occupant index of large rooms
+
+Before: every occupant wraps a sparkapi.Person holding a copy of the membership JSON and its own copy of the ID
+After: CiscoSparkRoomOccupant (slotted, only the used fields kept, interned IDs, a shared room instance)
+
+Two layouts are measured: a single room with every occupant and a set of rooms that share the same people, as the
+people of an organisation are usually members of many of its rooms.
+
+Usage: python benchmarks/occupant_memory.py [occupants]
+"""
+import base64
+import gc
+import json
+import os
+import sys
+import tracemalloc
+import uuid
+
+import ciscosparkapi as sparkapi
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from CiscoSpark import CiscoSparkRoom  # noqa
+
+
+def spark_id(kind):
+    return base64.b64encode('ciscospark://us/{}/{}'.format(kind, uuid.uuid4()).encode()).decode().rstrip('=')
+
+
+class Session(object):
+    """
+    Just enough of the sparkapi session to list the memberships of a room. The memberships are parsed from JSON on
+    every call, as they would be when received from Spark.
+    """
+    def __init__(self, people, rooms):
+        self._pages = {}
+        for room_id in rooms:
+            self._pages[room_id] = json.dumps([{
+                'id': spark_id('MEMBERSHIP'), 'roomId': room_id, 'personId': person_id,
+                'personEmail': 'person{}@example.com'.format(number), 'personDisplayName': 'Person {}'.format(number),
+                'isModerator': False, 'isMonitor': False, 'created': '2017-01-01T00:00:00.000Z'
+            } for number, person_id in enumerate(people)])
+        self.memberships = self
+
+    def list(self, roomId, **kwargs):
+        for membership in json.loads(self._pages[roomId]):
+            yield sparkapi.Membership(membership)
+
+
+class Bot(object):
+    def __init__(self, session):
+        self.session = session
+
+
+class LegacyRoom(object):
+    """
+    The previous representation: a room wrapping a sparkapi.Room with occupants wrapping sparkapi.Person objects
+    """
+    def __init__(self, bot, room_id):
+        self._bot = bot
+        self._spark_room = sparkapi.Room({'id': room_id, 'title': 'Room'})
+        self._members = None
+        self._member_emails = {}
+
+    def update_occupants(self):
+        members = {}
+        emails = {}
+        for membership in self._bot.session.memberships.list(roomId=self._spark_room.id):
+            data = membership._json_data
+            occupant = LegacyOccupant(self._bot, self, {
+                'id': data.get('personId'), 'emails': [data.get('personEmail')],
+                'displayName': data.get('personDisplayName')
+            })
+            members[occupant._spark_person.id] = occupant
+            emails[data.get('personEmail').lower()] = occupant._spark_person.id
+        self._members = members
+        self._member_emails = emails
+
+
+class LegacyOccupant(object):
+    def __init__(self, bot, room, person):
+        self._bot = bot
+        self._room = room
+        self._spark_person = sparkapi.Person(dict(person))
+
+
+def measure(factory, bot, room_ids):
+    gc.collect()
+    tracemalloc.start()
+    rooms = []
+    for room_id in room_ids:
+        room = factory(bot, room_id)
+        room.update_occupants()
+        rooms.append(room)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+
+def main():
+    occupants = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    layouts = [('1 room', 1, occupants), ('10 rooms', 10, occupants // 10)]
+
+    print('{:<10} {:>16} {:>16} {:>10}'.format('layout', 'before (MB/10k)', 'after (MB/10k)', 'saving'))
+
+    for name, rooms, people in layouts:
+        bot = Bot(Session([spark_id('PEOPLE') for _ in range(people)], [spark_id('ROOM') for _ in range(rooms)]))
+        room_ids = list(bot.session._pages)
+
+        scale = 10000 / (rooms * people) / 1024 / 1024
+        old = measure(LegacyRoom, bot, room_ids) * scale
+        new = measure(lambda bot, room_id: CiscoSparkRoom(bot, {'id': room_id, 'title': 'Room'}), bot, room_ids) * scale
+        print('{:<10} {:>16.2f} {:>16.2f} {:>9.0f}%'.format(name, old, new, (1 - new / old) * 100))
+
+
+if __name__ == '__main__':
+    main()
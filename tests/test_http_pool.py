@@ -0,0 +1,32 @@
+"""
+Tests of the HTTP connection pool of the backend against the fake Spark API of the benchmarks
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from end_to_end import Config  # noqa
+from fake_spark import FakeSparkAPI  # noqa
+from CiscoSpark import CiscoSparkBackend  # noqa
+
+REQUESTS = 20
+
+
+def connections_used(identity):
+    api = FakeSparkAPI(rooms=1).start()
+    try:
+        backend = CiscoSparkBackend(Config(api, 1, dict({'RATE_LIMIT': 1000}, **identity)))
+        for _ in range(REQUESTS):
+            backend.session.people.me()
+        return api.connections
+    finally:
+        api.stop()
+
+
+def test_requests_reuse_a_single_connection():
+    assert connections_used({}) == 1
+
+
+def test_requests_without_keepalive_use_a_connection_each():
+    assert connections_used({'HTTP_KEEPALIVE': False}) > REQUESTS